@@ -4,20 +4,31 @@
 # than a Network to allow for testing, applications to bipartite graphs, etc.
 # Daniel Klein, 4/4/2013
 
+import tempfile
 import numpy as np
 import scipy.sparse as sparse
 
-from Covariate import NodeCovariate, EdgeCovariate
+from Covariate import NodeCovariate, EdgeCovariate, FactoredEdgeCovariate
+from Covariate import MemmapEdgeCovariate, BlockOffset
+from Storage import new_storage, ViewStorage, load_archive, PackedMatrix
 
-class Array:
-    def __init__(self, M, N):
+class Array(object):
+    # With storage = 'memmap', the adjacency data, edge covariates and
+    # offset are kept in files in the scratch directory (a fresh
+    # temporary directory if none is given) instead of in memory.
+    def __init__(self, M, N, storage = 'csr', scratch = None):
         self.M = M
         self.N = N
+        self.storage = storage
+        if storage == 'memmap' and scratch is None:
+            scratch = tempfile.mkdtemp(prefix = 'array_')
+        self.scratch = scratch
 
         self.rnames = np.array(['m_%d' % m for m in range(self.M)])
         self.cnames = np.array(['n_%d' % n for n in range(self.N)])
         
-        self.array = sparse.lil_matrix((self.M, self.N), dtype = np.bool)
+        # Adjacency data lives in a storage backend; see Storage.py
+        self.data = new_storage(storage, self.M, self.N, scratch)
 
         # Offset initially set to None so simpler offset-free model
         # code can be used by default
@@ -27,8 +38,42 @@ class Array:
         self.col_covariates = {}
         self.edge_covariates = {}
 
+    # Reads see a compressed (CSR/CSC) matrix, or a dense array if one
+    # was assigned; writes through __setitem__ are buffered until then
+    @property
+    def array(self):
+        return self.data.read()
+
+    @array.setter
+    def array(self, x):
+        self.data.assign(x)
+
     def __setitem__(self, index, x):
-        self.array.__setitem__(index, x)
+        self.data.write(index, x)
+
+    # Batch edits: write values (or add or remove edges) at the cells
+    # (i[k], j[k]), for index arrays i and j, in one operation. Cached
+    # margins and the compressed form stay consistent with the data.
+    def set_cells(self, i, j, values):
+        self.data.set_cells(i, j, values)
+
+    def add_edges(self, i, j):
+        self.data.set_cells(i, j, True)
+
+    def remove_edges(self, i, j):
+        self.data.set_cells(i, j, False)
+
+    # Row and column margins (degrees) of the adjacency data, as
+    # read-only arrays, and the number of edges. For sparse data, these
+    # are cached by the storage backend and kept up to date as the data
+    # is written, so are cheap to query; dense data can be changed in
+    # place through as_dense(), so its margins are recomputed each time.
+    def margins(self):
+        r, c, total = self.data.margins()
+        return r, c
+
+    def edge_count(self):
+        return self.data.margins()[2]
 
     def new_row_covariate(self, name, dtype = np.float64):
         self.row_covariates[name] = NodeCovariate(self.rnames, dtype)
@@ -38,15 +83,31 @@ class Array:
         self.col_covariates[name] = NodeCovariate(self.cnames, dtype)
         return self.col_covariates[name]
 
+    def _new_edge_covariate(self):
+        if self.scratch is None:
+            return EdgeCovariate(self.rnames, self.cnames)
+        else:
+            return MemmapEdgeCovariate(self.rnames, self.cnames, self.scratch)
+
     def new_edge_covariate(self, name):
-        self.edge_covariates[name] = EdgeCovariate(self.rnames, self.cnames)
+        self.edge_covariates[name] = self._new_edge_covariate()
         return self.edge_covariates[name]
 
+    # Lazy edge covariate op(x_row_i, x_col_j), for node covariates (or
+    # vectors) x_row and x_col; see FactoredEdgeCovariate for the ops
+    def new_factored_edge_covariate(self, name, x_row, x_col, op):
+        cov = FactoredEdgeCovariate(self.rnames, self.cnames, x_row, x_col, op)
+        self.edge_covariates[name] = cov
+        return cov
+
     def initialize_offset(self):
-        self.offset = EdgeCovariate(self.rnames, self.cnames)
+        self.offset = self._new_edge_covariate()
         return self.offset
 
-    def subarray(self, rinds = None, cinds = None):
+    # With view = True, the adjacency data is only extracted when first
+    # used, and edge covariates and the offset are views that read from
+    # this array's until written to (see EdgeCovariateView).
+    def subarray(self, rinds = None, cinds = None, view = False):
         if rinds is None:
             rinds = np.arange(self.M)
         if cinds is None:
@@ -54,11 +115,16 @@ class Array:
 
         sub_M = len(rinds)
         sub_N = len(cinds)
-        sub = Array(sub_M, sub_N)
+        sub = Array(sub_M, sub_N, self.storage, self.scratch)
         sub.rnames = self.rnames[rinds]
         sub.cnames = self.cnames[cinds]
 
-        sub.array = self.array[rinds][:,cinds]
+        if view:
+            sub.data = ViewStorage(self.data, rinds, cinds)
+            sub_edge = lambda src: src.view(rinds, cinds)
+        else:
+            sub.array = self.data.subset(rinds, cinds)
+            sub_edge = lambda src: src.subset(rinds, cinds)
 
         for row_covariate in self.row_covariates:
             src = self.row_covariates[row_covariate]
@@ -68,13 +134,73 @@ class Array:
             sub.col_covariates[col_covariate] = src.subset(cinds)
         for edge_covariate in self.edge_covariates:
             src = self.edge_covariates[edge_covariate]
-            sub.edge_covariates[edge_covariate] = src.subset(rinds, cinds)
+            sub.edge_covariates[edge_covariate] = sub_edge(src)
 
         if self.offset:
-            sub.offset = self.offset.subset(rinds, cinds)
+            sub.offset = sub_edge(self.offset)
 
         return sub
 
+    # Save the adjacency data, covariates and offset to a single NPZ
+    # archive. It is written uncompressed, so that the arrays can be
+    # memory-mapped when loaded; see array_from_file_npz().
+    def save(self, path):
+        np.savez(path, **self._archive())
+
+    def _archive(self):
+        arrays = { 'shape': np.array([self.M, self.N]),
+                   'storage': np.array(self.storage),
+                   'rnames': self.rnames,
+                   'cnames': self.cnames }
+
+        A = sparse.csr_matrix(self.array)
+        arrays['array/data'] = A.data
+        arrays['array/indices'] = A.indices
+        arrays['array/indptr'] = A.indptr
+
+        for kind, covariates in [('row', self.row_covariates),
+                                 ('col', self.col_covariates)]:
+            names = self._archive_node_names(kind, covariates)
+            arrays['%s_names' % kind] = np.array(names)
+            for name in names:
+                arrays['%s/%s' % (kind, name)] = covariates[name].data
+
+        arrays['edge_names'] = np.array(self.edge_covariates.keys())
+        for name in self.edge_covariates:
+            archive_edge_covariate(arrays, 'edge/%s' % name,
+                                   self.edge_covariates[name])
+        if self.offset:
+            archive_edge_covariate(arrays, 'offset', self.offset)
+
+        return arrays
+
+    def _archive_node_names(self, kind, covariates):
+        return covariates.keys()
+
+    # Restore the adjacency data, covariates and offset from the arrays
+    # of an archive written by save()
+    def _unarchive(self, arrays):
+        self.array = sparse.csr_matrix((arrays['array/data'],
+                                        arrays['array/indices'],
+                                        arrays['array/indptr']),
+                                       shape = (self.M, self.N), copy = False)
+
+        for name in arrays['row_names']:
+            x = arrays['row/%s' % name]
+            self.new_row_covariate(str(name), x.dtype).data = x
+        for name in arrays['col_names']:
+            x = arrays['col/%s' % name]
+            self.new_col_covariate(str(name), x.dtype).data = x
+
+        for name in arrays['edge_names']:
+            self.edge_covariates[str(name)] = \
+              unarchive_edge_covariate(arrays, 'edge/%s' % name, self.rnames,
+                                       self.cnames, self.scratch)
+        if 'offset/kind' in arrays:
+            self.offset = unarchive_edge_covariate(arrays, 'offset',
+                                                   self.rnames, self.cnames,
+                                                   self.scratch)
+
     # Syntactic sugar to make array generation look like object mutation
     def generate(self, model, **opts):
         self.array = model.generate(self, **opts)
@@ -84,74 +210,197 @@ class Array:
         
     def as_dense(self):
         if self.is_sparse():
-            return np.asarray(self.array.todense())
+            return self.array.toarray()
         else:
             return self.array
 
+    # Bit-packed copy of the adjacency data; see PackedMatrix
+    def as_packed(self):
+        if self.is_sparse():
+            return PackedMatrix.from_sparse(self.array)
+        else:
+            return PackedMatrix.from_dense(self.array)
+
+    # Find the submatrices that will send the corresponding EMLE
+    # parameter estimates to infinity, replacing the offset with a
+    # BlockOffset fixing them at -inf/+inf (any existing offset is kept
+    # as its residual). Returns the remaining active set of cells, as a
+    # list of (row indices, column indices) rectangles.
     def offset_extremes(self):
-        if self.offset is None:
-            self.initialize_offset()
-
-        # (Separately) sort rows and columns of adjacency matrix by
-        # increasing sum
-        A = self.as_dense()
-        r_ord = np.argsort(A.sum(1))
-        c_ord = np.argsort(A.sum(0))
-        A = A[r_ord][:,c_ord]
-
-        # Convenience function to set blocks of the offset
-        def set_offset_block(r, c, val):
-            # Replacing this with a vectorized operation will require
-            # a conversion to CSR. It's not clear if this is worth the
-            # overhead.
-            for i in r_ord[r]:
-                for j in c_ord[c]:
-                    self.offset[i,j] = val
-
-        # Recursively examine for submatrices that will send
-        # corresponding EMLE parameter estimates to infinity
-        to_screen = [(np.arange(self.M), np.arange(self.N))]
-        while len(to_screen) > 0:
-            r_act, c_act = to_screen.pop()
-
-            if len(r_act) == 0 or len(c_act) == 0:
-                continue
-
-            A_act = A[r_act][:,c_act]
-            n_act = A_act.shape
-
-            # Cumulative sums allow for efficient bad substructure search
-            C_inc = np.cumsum(np.cumsum(A_act,1),0)
-            def reverse(x):
-                return x[range(n_act[0]-1,-1,-1)][:,range(n_act[1]-1,-1,-1)]
-            C_dec = reverse(np.cumsum(np.cumsum(reverse(1-A_act),1),0))
-
-            if C_inc[-1,-1] == 0:
-                set_offset_block(r_act, c_act, -np.inf)
-                continue
-            if C_dec[0,0] == 0:
-                set_offset_block(r_act, c_act, np.inf)
-                continue
-
-            align = np.zeros((n_act[0]+1,n_act[1]+1))
-            align[1:(n_act[0]+1)][:,1:(n_act[1]+1)] += (C_inc == 0)
-            align[0:n_act[0]][:,0:n_act[1]] *= (C_dec == 0)
-            splits = zip(*np.where(align))
-            if len(splits) == 0:
-                continue
-            i_split, j_split = splits[0]
-
-            set_offset_block(r_act[:i_split], c_act[:j_split], -np.inf)
-            set_offset_block(r_act[i_split:], c_act[j_split:], np.inf)
-
-            to_screen.append((r_act[i_split:], c_act[:j_split]))
-            to_screen.append((r_act[:i_split], c_act[j_split:]))
+        r_ord, c_ord, neg, pos, active = extreme_blocks(self.array)
+        self.offset = BlockOffset(self.rnames, self.cnames, r_ord, c_ord,
+                                  neg, pos, active, self.offset)
+
+        return self.offset.active_rectangles()
+
+# Recursive search of an adjacency matrix A, with rows and columns
+# (separately) sorted by increasing sum, for submatrices of all zeros
+# (neg) and all ones (pos) that send the corresponding EMLE parameter
+# estimates to -inf and +inf. Returns the sorting permutations r_ord
+# and c_ord, along with the neg, pos and remaining (active) blocks as
+# (r_0, r_1, c_0, c_1) ranges in the sorted order.
+#
+# A block can be split at (i, j) if its top-left i x j corner is all
+# zeros and its bottom-right corner is all ones. With f_k the position
+# of the first one in row k and l_k the position of the last zero, this
+# holds exactly when max(l_k, k >= i) < j <= min(f_k, k < i). These
+# are computed for all rows of a block at once from the sparse
+# structure, by binary search.
+def extreme_blocks(A):
+    A = sparse.csr_matrix(A, dtype = np.bool)
+    A.eliminate_zeros()
+    M, N = A.shape
+
+    r_ord = np.argsort(np.asarray(A.sum(1), dtype = np.int64).reshape(-1))
+    c_ord = np.argsort(np.asarray(A.sum(0), dtype = np.int64).reshape(-1))
+    A = A[r_ord][:,c_ord]
+    A.sort_indices()
+
+    # Keys for searching within rows: by column, and by column minus
+    # entry number (non-decreasing within a row; runs of consecutive
+    # ones share a value)
+    nnz = A.nnz
+    e = np.arange(nnz, dtype = np.int64)
+    cols = A.indices.astype(np.int64)
+    rows = np.repeat(np.arange(M, dtype = np.int64), np.diff(A.indptr))
+    S_1, S_2 = N + 1, N + nnz + 1
+    key_col = rows * S_1 + cols
+    key_run = rows * S_2 + (cols - e + nnz)
+    cols = np.append(cols, N)
+
+    neg, pos, active = [], [], []
+    to_screen = [(0, M, 0, N)]
+    while len(to_screen) > 0:
+        r_0, r_1, c_0, c_1 = to_screen.pop()
+        n_0, n_1 = r_1 - r_0, c_1 - c_0
+        if n_0 == 0 or n_1 == 0:
+            continue
+        block = (r_0, r_1, c_0, c_1)
+
+        k = np.arange(r_0, r_1, dtype = np.int64)
+        lo = np.searchsorted(key_col, k * S_1 + c_0)
+        hi = np.searchsorted(key_col, k * S_1 + c_1)
+        count = hi - lo
+
+        if count.sum() == 0:
+            neg.append(block)
+            continue
+        if count.sum() == n_0 * n_1:
+            pos.append(block)
+            continue
+
+        # Position (relative to the block) of first one in each row
+        f = np.where(count > 0, cols[lo] - c_0, n_1)
+
+        # Position of last zero in each row, from the length of the
+        # run of ones (if any) ending at the last column
+        run_start = np.searchsorted(key_run, k * S_2 + (c_1 - hi + nnz))
+        run = np.where((count > 0) & (cols[hi - 1] == c_1 - 1),
+                       hi - np.maximum(lo, run_start), 0)
+        l = np.where(count == n_1, -1, n_1 - 1 - run)
+
+        # Bounds on j for each split row i = 1, ..., n_0
+        l_after = np.append(np.maximum.accumulate(l[::-1])[::-1][1:], -1)
+        j_min = np.maximum(1, l_after + 1)
+        j_max = np.minimum.accumulate(f)
+        splits = np.where(j_min <= j_max)[0]
+        if len(splits) == 0:
+            active.append(block)
+            continue
+        i_split = splits[0] + 1
+        j_split = j_min[splits[0]]
+
+        neg.append((r_0, r_0 + i_split, c_0, c_0 + j_split))
+        pos.append((r_0 + i_split, r_1, c_0 + j_split, c_1))
+
+        to_screen.append((r_0 + i_split, r_1, c_0, c_0 + j_split))
+        to_screen.append((r_0, r_0 + i_split, c_0 + j_split, c_1))
+
+    return r_ord, c_ord, neg, pos, active
+
+# Arrays describing an edge covariate (or offset), stored under prefix
+def archive_edge_covariate(arrays, prefix, cov):
+    if isinstance(cov, FactoredEdgeCovariate):
+        arrays[prefix + '/kind'] = np.array('factored')
+        arrays[prefix + '/u'] = cov.u
+        arrays[prefix + '/v'] = cov.v
+        arrays[prefix + '/op'] = np.array(cov.op)
+    elif isinstance(cov, BlockOffset):
+        arrays[prefix + '/kind'] = np.array('block')
+        arrays[prefix + '/r_ord'] = cov.r_ord
+        arrays[prefix + '/c_ord'] = cov.c_ord
+        for name in ['neg', 'pos', 'active']:
+            blocks = np.array(getattr(cov, name), dtype = np.int64)
+            arrays[prefix + '/' + name] = blocks.reshape((-1,4))
+        if not cov.residual is None:
+            archive_edge_covariate(arrays, prefix + '/residual', cov.residual)
+    elif isinstance(cov, MemmapEdgeCovariate):
+        arrays[prefix + '/kind'] = np.array('dense')
+        arrays[prefix + '/values'] = cov.data
+    else:
+        x = cov.csr()
+        arrays[prefix + '/kind'] = np.array('sparse')
+        arrays[prefix + '/data'] = x.data
+        arrays[prefix + '/indices'] = x.indices
+        arrays[prefix + '/indptr'] = x.indptr
+
+def unarchive_edge_covariate(arrays, prefix, rnames, cnames, scratch):
+    kind = str(arrays[prefix + '/kind'])
+    if kind == 'factored':
+        return FactoredEdgeCovariate(rnames, cnames,
+                                     arrays[prefix + '/u'],
+                                     arrays[prefix + '/v'],
+                                     str(arrays[prefix + '/op']))
+    elif kind == 'block':
+        blocks = [[tuple([int(b) for b in block])
+                   for block in arrays[prefix + '/' + name]]
+                  for name in ['neg', 'pos', 'active']]
+        residual = None
+        if prefix + '/residual/kind' in arrays:
+            residual = unarchive_edge_covariate(arrays, prefix + '/residual',
+                                                rnames, cnames, scratch)
+        return BlockOffset(rnames, cnames, arrays[prefix + '/r_ord'],
+                           arrays[prefix + '/c_ord'], blocks[0], blocks[1],
+                           blocks[2], residual)
+    elif kind == 'dense':
+        x = arrays[prefix + '/values']
+        if not scratch is None:
+            return MemmapEdgeCovariate(rnames, cnames, scratch, x)
+        cov = EdgeCovariate(rnames, cnames)
+        cov.from_matrix(x)
+        return cov
+    else:
+        data = arrays[prefix + '/data']
+        x = sparse.csr_matrix((data,
+                               arrays[prefix + '/indices'],
+                               arrays[prefix + '/indptr']),
+                              shape = (len(rnames), len(cnames)), copy = False)
+        cov = EdgeCovariate(rnames, cnames)
+        if isinstance(data, np.memmap):
+            # Keep the memory-mapped CSR form, rather than reading it
+            # all in to build a LIL matrix
+            cov.data = x
+        else:
+            cov.data = x.tolil()
+        return cov
+
+# Load an Array saved with Array.save(). With mmap = True, the arrays
+# in the file are memory-mapped rather than read in up front.
+def array_from_file_npz(path, mmap = False):
+    arrays = load_archive(path, mmap)
+    M, N = [int(n) for n in arrays['shape']]
+    arr = Array(M, N, str(arrays['storage']))
+    arr.rnames = arrays['rnames']
+    arr.cnames = arrays['cnames']
+    arr._unarchive(arrays)
+
+    return arr
 
 def array_from_data(z, xs = []):
     """Populate an Array with data z and covariates xs."""
     M, N = z.shape
     arr = Array(M, N)
-    arr.array[:] = z
+    arr.array = sparse.csr_matrix(np.asarray(z, dtype = np.bool))
 
     for i, x in enumerate(xs):
         arr.new_edge_covariate('x_%d' % i)[:] = x
@@ -310,13 +310,28 @@ def clear_cache():
     _dict_conjugate = {}
 
 _dict_canonical_scalings = {}
-def canonical_scalings(w, r, c):
+
+# Cache key for the scalings of the weights identified by w_key, pruned
+# according to the (unpruned) margins r and c
+def _scalings_key(w_key, r, c):
+    if w_key is None:
+        return None
+    return ('pruned', w_key,
+            np.asarray(r, dtype = np.int64).tostring(),
+            np.asarray(c, dtype = np.int64).tostring())
+
+def canonical_scalings(w, r, c, key = None):
     """From weights and margins, find scalings to balance a matrix.
 
+If given, key identifies (w, r, c) in the cache of scalings, saving
+the hashing of w.
+
 TODO: describe "rc" method.
     """
-    w_hash = digest(w)
-    hash = (w_hash, tuple(r), tuple(c))
+    if key is None:
+        hash = (digest(w), tuple(r), tuple(c))
+    else:
+        hash = key
     if hash in _dict_canonical_scalings:
         return _dict_canonical_scalings[hash]
 
@@ -460,7 +475,7 @@ def _prune(r, c, *arrays):
     return r, c, [a.copy() for a in arrays], unprune
 
 def approximate_from_margins_weights(r, c, w, T = None,
-                                     sort_by_wopt_var = True):
+                                     sort_by_wopt_var = True, w_key = None):
     """Return approximate samples from row/column-conditional binary matrices.
                                      
 Return a binary matrix (or a list of binary matrices) sampled
@@ -472,6 +487,7 @@ Inputs:
   w: weight matrix, (m x n) matrix with values in (0, +infty)
   T: number of matrices to sample
   sort_by_wopt_var: when enabled, column ordering depends on w
+  w_key: (optional) hashable key identifying w, for caching
 Output:
   B_sample_sparse: (T default) sparse representation of (m x n) binary matrix
                    (T >= 1) list of (sparse binary matrices, logQ, logP)
@@ -501,6 +517,7 @@ B_sample can be recovered from B_sample_sparse via:
         if i == -1: break 
         B_sample[i,j] = 1
 """
+    scalings_key = _scalings_key(w_key, r, c)
     r_prune, c_prune, arrays_prune, unprune = _prune(r, c, w)
     w_prune = arrays_prune[0]
 
@@ -524,7 +541,8 @@ B_sample can be recovered from B_sample_sparse via:
     rsort = r_prune[rndx_init]
 
     # Balance the weights
-    a_scale, b_scale = canonical_scalings(w_prune, r_prune, c_prune)
+    a_scale, b_scale = canonical_scalings(w_prune, r_prune, c_prune,
+                                          scalings_key)
     wopt = apply_scale(w_prune, a_scale, b_scale)
 
     # Reorder the columns
@@ -564,7 +582,8 @@ B_sample can be recovered from B_sample_sparse via:
     else:
         return do_sample()[0]
 
-def approximate_conditional_nll(A, w, sort_by_wopt_var = True):
+def approximate_conditional_nll(A, w, sort_by_wopt_var = True,
+                                w_key = None):
     """Return approximate row/column-conditional NLL of binary matrix.
     
 Return the approximate nll of an observed binary matrix given
@@ -574,6 +593,7 @@ margins.
 Inputs:
   A: observed data, (m x n) binary matrix
   w: weight matrix, (m x n) matrix with values in (0, +infty)
+  w_key: (optional) hashable key identifying w, for caching
 Output:
   ncll: negative conditional log-likelihood
 """
@@ -581,6 +601,7 @@ Output:
 
     r = A.sum(1, dtype=np.int)
     c = A.sum(0, dtype=np.int)
+    scalings_key = _scalings_key(w_key, r, c)
 
     r, c, arrays, _ = _prune(r, c, A, w)
     A, w = arrays
@@ -595,7 +616,7 @@ Output:
     rsort = r[rndx]
 
     # Balance the weights
-    a_scale, b_scale = canonical_scalings(w, r, c)
+    a_scale, b_scale = canonical_scalings(w, r, c, scalings_key)
     wopt = apply_scale(w, a_scale, b_scale)
     if np.isnan(wopt).any():
         wopt = w
@@ -6,6 +6,14 @@
 import numpy as np
 
 from Utility import logsumexp
+from Storage import PackedMatrix
+
+# Sum of suff over the cells set in the binary matrix z, which may be
+# bit-packed
+def suff_sum(suff, z):
+    if isinstance(z, PackedMatrix):
+        return z.masked_sum(suff)
+    return (suff * z).sum()
 
 def invert_test(theta_grid, test_val, crit):
     theta_l_min, theta_l_max = theta_grid.min(), theta_grid.max()
@@ -69,6 +77,10 @@ def ci_conservative_generic(X, K, theta_grid, alpha_level,
     for k in range(K):
         log_Q_sum_Y[k] = logsumexp(log_Q_Y[:,k])
 
+    # Nor do the sufficient statistics...
+    suff_X = suff_sum(suff, X)
+    suff_Y = np.array([suff_sum(suff, Y[k]) for k in range(K)])
+
     # Step over the grid, calculating approximate p-values
     if two_sided:
         log_p_plus = np.empty(L)
@@ -79,13 +91,13 @@ def ci_conservative_generic(X, K, theta_grid, alpha_level,
 
         # X contribution
         if corrected:
-            log_w_l[K] = theta_l * (suff * X).sum() - log_Q_sum_X
+            log_w_l[K] = theta_l * suff_X - log_Q_sum_X
         else:
             log_w_l[K] = -np.inf
 
         # Y contribution
         for k in range(K):
-            log_w_l[k] = theta_l * (suff * Y[k]).sum() - log_Q_sum_Y[k]
+            log_w_l[k] = theta_l * suff_Y[k] - log_Q_sum_Y[k]
 
         if two_sided:
             log_p_num_plus = logsumexp(log_w_l[I_t_Y_plus[l]])
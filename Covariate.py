@@ -6,11 +6,41 @@
 import numpy as np
 import scipy.sparse as sparse
 
+from Utility import row_blocks
+from Storage import memmap_array, merge_cells
+
+# Positions of names in an array of (distinct) names, looked up for
+# whole arrays of names at once by binary search. The sort is done on
+# first use, and the index is only valid as long as the names aren't
+# changed in place.
+class NameIndex:
+    def __init__(self, names):
+        self.names = np.asarray(names)
+        self.order = None
+
+    def find(self, names):
+        if self.order is None:
+            self.order = np.argsort(self.names, kind = 'mergesort')
+            self.sorted_names = self.names[self.order]
+
+        names = np.asarray(names)
+        if len(self.names) == 0 or names.size == 0:
+            return -np.ones(names.shape, dtype = np.int)
+        dtype = np.promote_types(self.sorted_names.dtype, names.dtype)
+        sorted_names = self.sorted_names.astype(dtype)
+        names = names.astype(dtype)
+
+        pos = np.searchsorted(sorted_names, names).clip(0, len(self.names) - 1)
+        return np.where(sorted_names[pos] == names, self.order[pos], -1)
+
 class NodeCovariate:
-    def __init__(self, names, dtype = np.float):
+    def __init__(self, names, dtype = np.float, index = None):
         self.names = names
         self.dtype = dtype
         self.data = np.zeros(len(names), dtype = dtype)
+        if index is None:
+            index = NameIndex(names)
+        self.index = index
 
     def __str__(self):
         return '<NodeCovariate\n%s\n%s>' % (repr(self.names),repr(self.data))
@@ -29,14 +59,11 @@ class NodeCovariate:
 
         return sub
 
+    # Assign values by name; names not present are ignored
     def from_pairs(self, names, values):
-        n_to_ind = {}
-        for i, n in enumerate(self.names):
-            n_to_ind[n] = i
-
-        for n, v in zip(names, values):
-            if not n in n_to_ind: continue
-            self.data[n_to_ind[n]] = v
+        inds = self.index.find(names)
+        known = inds >= 0
+        self.data[inds[known]] = np.asarray(values)[known]
 
     def show_histogram(self):
         import matplotlib.pyplot as plt
@@ -46,7 +73,7 @@ class NodeCovariate:
         plt.show()
 
     def copy(self):
-        new = NodeCovariate(self.names, self.dtype)
+        new = NodeCovariate(self.names, self.dtype, self.index)
         new.data = self.data.copy()
         return new
 
@@ -74,10 +101,17 @@ class EdgeCovariate:
 
         return new
 
+    # Vectorized assignment of x[k] to the cells (i[k], j[k])
+    def set_cells(self, i, j, x):
+        x = np.broadcast_to(np.asarray(x, dtype = np.float64), np.shape(i))
+        self.data = merge_cells(self.csr(), i, j, x).tolil()
+        self.dirty()
+
     # Indicate that matrix should not used a cached version
     def dirty(self):
         self.is_dirty = True
         self.cached_matrix = None
+        self.cached_csr = None
 
     def matrix(self):
         if self.is_dirty:
@@ -89,12 +123,56 @@ class EdgeCovariate:
     def sparse_matrix(self):
         return self.data
 
+    def csr(self):
+        if self.cached_csr is None:
+            self.cached_csr = self.data.tocsr()
+
+        return self.cached_csr
+
+    # Values at the cells (i[k], j[k]), without forming the dense matrix
+    def values_at(self, i, j):
+        if len(i) == 0:
+            return np.zeros(0)
+        if not self.is_dirty:
+            return self.cached_matrix[i,j]
+
+        return np.asarray(self.csr()[i,j], dtype = np.float64).reshape(-1)
+
+    # Dense values for the block of rows start:stop
+    def rows(self, start, stop):
+        if not self.is_dirty:
+            return self.cached_matrix[start:stop]
+
+        return self.csr()[start:stop].toarray()
+
+    # Reductions of x * P, where P is the block of an array (e.g., of
+    # edge probabilities) covering the rows start:(start + len(P))
+    def dot(self, P, start = 0):
+        return (P * self.rows(start, start + P.shape[0])).sum()
+
+    def dot_rows(self, P, start = 0):
+        return (P * self.rows(start, start + P.shape[0])).sum(1)
+
+    def dot_cols(self, P, start = 0):
+        return (P * self.rows(start, start + P.shape[0])).sum(0)
+
     def subset(self, rinds, cinds):
         sub = EdgeCovariate(self.rnames[rinds], self.cnames[cinds])
-        sub.data[:,:] = self.data[rinds][:,cinds]
+        sub.data = self.csr()[rinds][:,cinds].tolil()
 
         return sub
 
+    # Lightweight alternative to subset; see EdgeCovariateView
+    def view(self, rinds, cinds):
+        return EdgeCovariateView(self, rinds, cinds)
+
+    # Dense values for the cells in rows rinds and columns cinds
+    def take(self, rinds, cinds):
+        if not self.is_dirty:
+            return self.cached_matrix[np.ix_(rinds, cinds)]
+
+        return self.csr()[rinds][:,cinds].toarray()
+
     def from_binary_function_name(self, f):
         for i, n_1 in enumerate(self.rnames):
             for j, n_2 in enumerate(self.cnames):
@@ -110,3 +188,618 @@ class EdgeCovariate:
                 if val != 0:
                     self.data[i,j] = val
         self.dirty()
+
+    # Vectorized alternatives to the above. Each replaces the existing
+    # data, calling f once per block of rows with broadcastable arrays
+    # (a column of row indices/names/values and a row of column
+    # indices/names/values) and expecting the block of values back.
+    def from_array_function_ind(self, f):
+        i = np.arange(len(self.rnames)).reshape((-1,1))
+        j = np.arange(len(self.cnames)).reshape((1,-1))
+        self._fill_rows(lambda start, stop: f(i[start:stop], j))
+
+    def from_array_function_name(self, f):
+        n_1 = np.asarray(self.rnames).reshape((-1,1))
+        n_2 = np.asarray(self.cnames).reshape((1,-1))
+        self._fill_rows(lambda start, stop: f(n_1[start:stop], n_2))
+
+    # Outer operation on a row and a column node covariate, e.g.,
+    # from_node_covariates(x, x, np.subtract)
+    def from_node_covariates(self, x_row, x_col, f):
+        v_1 = np.asarray(x_row[:]).reshape((-1,1))
+        v_2 = np.asarray(x_col[:]).reshape((1,-1))
+        self._fill_rows(lambda start, stop: f(v_1[start:stop], v_2))
+
+    def from_matrix(self, x):
+        if sparse.issparse(x):
+            self.data = sparse.lil_matrix(x, dtype = np.float64)
+        else:
+            self.data = sparse.lil_matrix(np.asarray(x, dtype = np.float64))
+        self.dirty()
+
+    def _fill_rows(self, f_block):
+        M, N = len(self.rnames), len(self.cnames)
+
+        nz_i, nz_j, nz_x = [], [], []
+        for start, stop in row_blocks(M, N):
+            x = np.broadcast_to(f_block(start, stop), (stop - start, N))
+            i, j = np.nonzero(x)
+            nz_i.append(i + start)
+            nz_j.append(j)
+            nz_x.append(np.asarray(x[i,j], dtype = np.float64))
+
+        x = sparse.coo_matrix((np.concatenate(nz_x),
+                               (np.concatenate(nz_i), np.concatenate(nz_j))),
+                              shape = (M, N))
+        self.data = x.tolil()
+        self.dirty()
+
+# View of the cells in rows rinds and columns cinds of a parent edge
+# covariate. Values are read from the parent as needed; the first write
+# (copy-on-write) detaches the view into an ordinary subset, after
+# which the parent is no longer referenced. Until then, changes to the
+# parent show through.
+class EdgeCovariateView(EdgeCovariate):
+    def __init__(self, parent, rinds, cinds):
+        self.rinds = np.arange(len(parent.rnames))[rinds]
+        self.cinds = np.arange(len(parent.cnames))[cinds]
+        self.rnames = parent.rnames[self.rinds]
+        self.cnames = parent.cnames[self.cinds]
+        self.parent = parent
+        self.owned = None
+
+    def __str__(self):
+        return '<EdgeCovariateView\n%s\n%s\n%s>' % \
+              (repr(self.rnames), repr(self.cnames), repr(self.matrix()))
+
+    # Detach from the parent, returning the now-owned covariate
+    def own(self):
+        if self.owned is None:
+            self.owned = self.parent.subset(self.rinds, self.cinds)
+            self.parent = None
+        return self.owned
+
+    def __getitem__(self, index):
+        if self.owned is None:
+            return self.matrix().__getitem__(index)
+        return self.owned.__getitem__(index)
+
+    def __setitem__(self, index, x):
+        self.own().__setitem__(index, x)
+
+    def set_cells(self, i, j, x):
+        self.own().set_cells(i, j, x)
+
+    def copy(self):
+        if self.owned is None:
+            return EdgeCovariateView(self.parent, self.rinds, self.cinds)
+        return self.owned.copy()
+
+    def dirty(self):
+        if not self.owned is None:
+            self.owned.dirty()
+
+    def matrix(self):
+        if self.owned is None:
+            return self.parent.take(self.rinds, self.cinds)
+        return self.owned.matrix()
+
+    def sparse_matrix(self):
+        if self.owned is None:
+            return self.parent.csr()[self.rinds][:,self.cinds]
+        return self.owned.sparse_matrix()
+
+    def csr(self):
+        return sparse.csr_matrix(self.sparse_matrix())
+
+    def subset(self, rinds, cinds):
+        if self.owned is None:
+            return self.parent.subset(self.rinds[rinds], self.cinds[cinds])
+        return self.owned.subset(rinds, cinds)
+
+    def view(self, rinds, cinds):
+        if self.owned is None:
+            return self.parent.view(self.rinds[rinds], self.cinds[cinds])
+        return self.owned.view(rinds, cinds)
+
+    def take(self, rinds, cinds):
+        if self.owned is None:
+            return self.parent.take(self.rinds[rinds], self.cinds[cinds])
+        return self.owned.take(rinds, cinds)
+
+    def values_at(self, i, j):
+        if self.owned is None:
+            return self.parent.values_at(self.rinds[i], self.cinds[j])
+        return self.owned.values_at(i, j)
+
+    def rows(self, start, stop):
+        if self.owned is None:
+            return self.parent.take(self.rinds[start:stop], self.cinds)
+        return self.owned.rows(start, stop)
+
+    def from_binary_function_name(self, f):
+        self.own().from_binary_function_name(f)
+
+    def from_binary_function_ind(self, f):
+        self.own().from_binary_function_ind(f)
+
+    def from_matrix(self, x):
+        self.own().from_matrix(x)
+
+    def _fill_rows(self, f_block):
+        self.own()._fill_rows(f_block)
+
+# Edge covariate whose (dense) values live in a file in a scratch
+# directory, rather than in a sparse matrix plus a cached dense copy in
+# memory. matrix() and rows() give views into the file.
+class MemmapEdgeCovariate(EdgeCovariate):
+    # The values can also be given as an existing (e.g., memory-mapped)
+    # array, which is used as is
+    def __init__(self, rnames, cnames, scratch, data = None):
+        self.rnames = rnames
+        self.cnames = cnames
+        self.scratch = scratch
+        if data is None:
+            self.data = memmap_array(scratch, (len(rnames), len(cnames)))
+            self.data[...] = 0.0
+        else:
+            self.data = data
+
+    def __setitem__(self, index, x):
+        self.data.__setitem__(index, x)
+
+    def set_cells(self, i, j, x):
+        self.data[i,j] = x
+
+    def copy(self):
+        new = MemmapEdgeCovariate(self.rnames, self.cnames, self.scratch)
+        for start, stop in row_blocks(*self.data.shape):
+            new.data[start:stop] = self.data[start:stop]
+        return new
+
+    def dirty(self):
+        pass
+
+    def matrix(self):
+        return self.data
+
+    def sparse_matrix(self):
+        blocks = [sparse.csr_matrix(self.data[start:stop])
+                  for start, stop in row_blocks(*self.data.shape)]
+        return sparse.vstack(blocks, format = 'csr')
+
+    def csr(self):
+        return self.sparse_matrix()
+
+    def values_at(self, i, j):
+        return self.data[i,j]
+
+    def rows(self, start, stop):
+        return self.data[start:stop]
+
+    def take(self, rinds, cinds):
+        return self.data[np.ix_(rinds, cinds)]
+
+    def subset(self, rinds, cinds):
+        sub = MemmapEdgeCovariate(self.rnames[rinds], self.cnames[cinds],
+                                  self.scratch)
+        rinds = np.arange(self.data.shape[0])[rinds]
+        for start, stop in row_blocks(len(rinds), self.data.shape[1]):
+            sub.data[start:stop] = self.data[rinds[start:stop]][:,cinds]
+        return sub
+
+    def from_matrix(self, x):
+        for start, stop in row_blocks(*self.data.shape):
+            if sparse.issparse(x):
+                self.data[start:stop] = x[start:stop].toarray()
+            else:
+                self.data[start:stop] = x[start:stop]
+
+    def _fill_rows(self, f_block):
+        N = self.data.shape[1]
+        for start, stop in row_blocks(*self.data.shape):
+            self.data[start:stop] = np.broadcast_to(f_block(start, stop),
+                                                    (stop - start, N))
+
+# Edge covariate x_{ij} = op(u_i, v_j) determined by a row vector u, a
+# column vector v, and an operator. Only u and v are stored; blocks of
+# values are generated on demand and the reductions used in model
+# fitting exploit the structure where possible, so the dense matrix
+# is never cached.
+class FactoredEdgeCovariate(EdgeCovariate):
+    ops = { 'difference': np.subtract,
+            'product': np.multiply,
+            'equality': np.equal,
+            'distance': lambda u, v: np.abs(u - v) }
+
+    def __init__(self, rnames, cnames, u, v, op):
+        if not op in self.ops:
+            raise ValueError('unknown operator "%s"' % op)
+        self.rnames = rnames
+        self.cnames = cnames
+        self.u = np.array(u[:], dtype = np.float64)
+        self.v = np.array(v[:], dtype = np.float64)
+        self.op = op
+
+    def __str__(self):
+        return '<FactoredEdgeCovariate (%s)\n%s\n%s\n%s\n%s>' % \
+              (self.op, repr(self.rnames), repr(self.cnames),
+               repr(self.u), repr(self.v))
+
+    def _values(self, u, v):
+        return np.asarray(self.ops[self.op](u, v), dtype = np.float64)
+
+    def __getitem__(self, index):
+        if type(index) == tuple and len(index) == 2:
+            i, j = index
+            if np.isscalar(i) and np.isscalar(j):
+                return self._values(self.u[i], self.v[j])
+        return self.matrix().__getitem__(index)
+
+    def __setitem__(self, index, x):
+        raise TypeError('FactoredEdgeCovariate is read-only')
+
+    def set_cells(self, i, j, x):
+        raise TypeError('FactoredEdgeCovariate is read-only')
+
+    def copy(self):
+        return FactoredEdgeCovariate(self.rnames, self.cnames,
+                                     self.u, self.v, self.op)
+
+    def dirty(self):
+        pass
+
+    def matrix(self):
+        return self.rows(0, len(self.u))
+
+    def sparse_matrix(self):
+        return sparse.csr_matrix(self.matrix())
+
+    def csr(self):
+        return self.sparse_matrix()
+
+    def subset(self, rinds, cinds):
+        return FactoredEdgeCovariate(self.rnames[rinds], self.cnames[cinds],
+                                     self.u[rinds], self.v[cinds], self.op)
+
+    # Subsets are already cheap
+    def view(self, rinds, cinds):
+        return self.subset(rinds, cinds)
+
+    def take(self, rinds, cinds):
+        return self._values(self.u[rinds].reshape((-1,1)),
+                            self.v[cinds].reshape((1,-1)))
+
+    def values_at(self, i, j):
+        return self._values(self.u[i], self.v[j])
+
+    def rows(self, start, stop):
+        return self._values(self.u[start:stop].reshape((-1,1)),
+                            self.v.reshape((1,-1)))
+
+    # Sums of P over the cells where u_i == v_j, by row and by column
+    def _equality_sums(self, P, u):
+        levels, codes = np.unique(np.concatenate([u, self.v]),
+                                  return_inverse = True)
+        u_codes, v_codes = codes[:len(u)], codes[len(u):]
+
+        # Sum P within groups of x_codes along the given axis, then pick
+        # out the group matching each of y_codes (zero if none does)
+        def grouped_sums(x_codes, y_codes, axis):
+            order = np.argsort(x_codes, kind = 'mergesort')
+            sorted_codes = x_codes[order]
+            starts = np.flatnonzero(np.r_[True, np.diff(sorted_codes) != 0])
+            sums = np.add.reduceat(np.take(P, order, axis), starts, axis)
+            sums = np.insert(sums, len(starts), 0.0, axis)
+            group = np.repeat(len(starts), len(levels))
+            group[sorted_codes[starts]] = np.arange(len(starts))
+            return sums, group[y_codes]
+
+        sums, group = grouped_sums(v_codes, u_codes, 1)
+        by_row = sums[np.arange(len(u_codes)),group]
+        sums, group = grouped_sums(u_codes, v_codes, 0)
+        by_col = sums[group,np.arange(len(v_codes))]
+        return by_row, by_col
+
+    def dot(self, P, start = 0):
+        return self.dot_rows(P, start).sum()
+
+    def dot_rows(self, P, start = 0):
+        u = self.u[start:(start + P.shape[0])]
+        if self.op == 'product':
+            return u * np.dot(P, self.v)
+        elif self.op == 'difference':
+            return u * P.sum(1) - np.dot(P, self.v)
+        elif self.op == 'equality':
+            return self._equality_sums(P, u)[0]
+        else:
+            return EdgeCovariate.dot_rows(self, P, start)
+
+    def dot_cols(self, P, start = 0):
+        u = self.u[start:(start + P.shape[0])]
+        if self.op == 'product':
+            return np.dot(u, P) * self.v
+        elif self.op == 'difference':
+            return np.dot(u, P) - P.sum(0) * self.v
+        elif self.op == 'equality':
+            return self._equality_sums(P, u)[1]
+        else:
+            return EdgeCovariate.dot_cols(self, P, start)
+
+# Offset of block effects Theta[z_i, z_j], for integer block labels
+# z_row and z_col and a K x K array Theta, on top of a base offset
+# (None for none). Only the labels and Theta are stored, and values
+# are looked up on demand, so the base offset is neither copied nor
+# modified.
+class BlockEffectOffset(EdgeCovariate):
+    def __init__(self, rnames, cnames, z_row, z_col, Theta, base = None):
+        self.rnames = rnames
+        self.cnames = cnames
+        self.z_row = np.asarray(z_row[:])
+        self.z_col = np.asarray(z_col[:])
+        self.Theta = np.array(Theta, dtype = np.float64)
+        self.base = base
+
+    def __str__(self):
+        return '<BlockEffectOffset\n%s\n%s\n%s>' % \
+              (repr(self.rnames), repr(self.cnames), repr(self.Theta))
+
+    def _with_base(self, x, f_base):
+        if not self.base is None:
+            x += f_base(self.base)
+        return x
+
+    def __getitem__(self, index):
+        if type(index) == tuple and len(index) == 2:
+            i, j = index
+            if np.isscalar(i) and np.isscalar(j):
+                return self.values_at(np.array([i]), np.array([j]))[0]
+        return self.matrix().__getitem__(index)
+
+    def __setitem__(self, index, x):
+        raise TypeError('BlockEffectOffset is read-only')
+
+    def set_cells(self, i, j, x):
+        raise TypeError('BlockEffectOffset is read-only')
+
+    def copy(self):
+        base = self.base
+        if not base is None:
+            base = base.copy()
+        return BlockEffectOffset(self.rnames, self.cnames, self.z_row,
+                                 self.z_col, self.Theta, base)
+
+    def dirty(self):
+        pass
+
+    def matrix(self):
+        return self.rows(0, len(self.z_row))
+
+    def sparse_matrix(self):
+        return sparse.csr_matrix(self.matrix())
+
+    def csr(self):
+        return self.sparse_matrix()
+
+    def _restrict(self, rinds, cinds, base):
+        return BlockEffectOffset(self.rnames[rinds], self.cnames[cinds],
+                                 self.z_row[rinds], self.z_col[cinds],
+                                 self.Theta, base)
+
+    def subset(self, rinds, cinds):
+        base = self.base
+        if not base is None:
+            base = base.subset(rinds, cinds)
+        return self._restrict(rinds, cinds, base)
+
+    def view(self, rinds, cinds):
+        base = self.base
+        if not base is None:
+            base = base.view(rinds, cinds)
+        return self._restrict(rinds, cinds, base)
+
+    def take(self, rinds, cinds):
+        x = self.Theta[self.z_row[rinds].reshape((-1,1)),
+                       self.z_col[cinds].reshape((1,-1))]
+        return self._with_base(x, lambda b: b.take(rinds, cinds))
+
+    def values_at(self, i, j):
+        x = self.Theta[self.z_row[i], self.z_col[j]]
+        return self._with_base(x, lambda b: b.values_at(i, j))
+
+    def rows(self, start, stop):
+        x = self.Theta[self.z_row[start:stop].reshape((-1,1)),
+                       self.z_col.reshape((1,-1))]
+        return self._with_base(x, lambda b: b.rows(start, stop))
+
+# Offset made up of rectangular blocks of -inf and +inf cells, e.g.,
+# as found by Array.offset_extremes(), over an optional residual edge
+# covariate. Rows and columns are permuted by r_ord and c_ord, in
+# which order each block covers a contiguous range, given as a tuple
+# (r_0, r_1, c_0, c_1). The blocks in active cover the cells that
+# aren't fixed at -inf/+inf; only these need to be visited by code
+# evaluating the model, and the residual only matters on them.
+class BlockOffset(EdgeCovariate):
+    def __init__(self, rnames, cnames, r_ord, c_ord, neg, pos, active,
+                 residual = None):
+        self.rnames = rnames
+        self.cnames = cnames
+        self.r_ord = np.asarray(r_ord, dtype = np.int64)
+        self.c_ord = np.asarray(c_ord, dtype = np.int64)
+        self.r_pos = np.empty_like(self.r_ord)
+        self.r_pos[self.r_ord] = np.arange(len(self.r_ord))
+        self.c_pos = np.empty_like(self.c_ord)
+        self.c_pos[self.c_ord] = np.arange(len(self.c_ord))
+        self.neg = list(neg)
+        self.pos = list(pos)
+        self.active = list(active)
+        self.residual = residual
+        self.dirty()
+
+    def __str__(self):
+        return '<BlockOffset (%d neg, %d pos, %d active blocks)\n%s\n%s>' % \
+              (len(self.neg), len(self.pos), len(self.active),
+               repr(self.rnames), repr(self.cnames))
+
+    def _rectangle(self, block):
+        r_0, r_1, c_0, c_1 = block
+        return self.r_ord[r_0:r_1], self.c_ord[c_0:c_1]
+
+    # Blocks in terms of the original row and column indices, as lists
+    # of (row indices, column indices) rectangles
+    def neg_rectangles(self):
+        return [self._rectangle(block) for block in self.neg]
+
+    def pos_rectangles(self):
+        return [self._rectangle(block) for block in self.pos]
+
+    def active_rectangles(self):
+        return [self._rectangle(block) for block in self.active]
+
+    # Number of cells fixed at +inf
+    def pos_inf_count(self):
+        return sum([(r_1 - r_0) * (c_1 - c_0)
+                    for r_0, r_1, c_0, c_1 in self.pos])
+
+    def __getitem__(self, index):
+        return self.matrix().__getitem__(index)
+
+    # Writes may land in the -inf/+inf blocks, so the structure is
+    # given up: the full offset becomes the residual, with everything
+    # active.
+    def flatten(self):
+        if len(self.neg) == 0 and len(self.pos) == 0 and \
+           not self.residual is None:
+            return
+        M, N = len(self.rnames), len(self.cnames)
+        residual = EdgeCovariate(self.rnames, self.cnames)
+        residual.from_matrix(self.matrix())
+        BlockOffset.__init__(self, self.rnames, self.cnames,
+                             np.arange(M), np.arange(N), [], [],
+                             [(0, M, 0, N)], residual)
+
+    def __setitem__(self, index, x):
+        self.flatten()
+        self.residual.__setitem__(index, x)
+        self.dirty()
+
+    def set_cells(self, i, j, x):
+        self.flatten()
+        self.residual.set_cells(i, j, x)
+        self.dirty()
+
+    def copy(self):
+        residual = self.residual
+        if not residual is None:
+            residual = residual.copy()
+        return BlockOffset(self.rnames, self.cnames, self.r_ord, self.c_ord,
+                           self.neg, self.pos, self.active, residual)
+
+    def dirty(self):
+        self.cached_matrix = None
+
+    def matrix(self):
+        if self.cached_matrix is None:
+            self.cached_matrix = self.take(np.arange(len(self.rnames)),
+                                           np.arange(len(self.cnames)))
+        return self.cached_matrix
+
+    def sparse_matrix(self):
+        return sparse.csr_matrix(self.matrix())
+
+    def csr(self):
+        return self.sparse_matrix()
+
+    def _fill(self, x, p, q):
+        for blocks, val in [(self.neg, -np.inf), (self.pos, np.inf)]:
+            for r_0, r_1, c_0, c_1 in blocks:
+                in_r = (r_0 <= p) & (p < r_1)
+                in_c = (c_0 <= q) & (q < c_1)
+                if in_r.any() and in_c.any():
+                    x[np.ix_(in_r, in_c)] = val
+        return x
+
+    def take(self, rinds, cinds):
+        if not self.cached_matrix is None:
+            return self.cached_matrix[np.ix_(rinds, cinds)]
+        if self.residual is None:
+            x = np.zeros((len(rinds), len(cinds)))
+        else:
+            x = np.array(self.residual.take(rinds, cinds), dtype = np.float64)
+        return self._fill(x, self.r_pos[rinds], self.c_pos[cinds])
+
+    def rows(self, start, stop):
+        if not self.cached_matrix is None:
+            return self.cached_matrix[start:stop]
+        if self.residual is None:
+            x = np.zeros((stop - start, len(self.cnames)))
+        else:
+            x = np.array(self.residual.rows(start, stop), dtype = np.float64)
+        return self._fill(x, self.r_pos[start:stop], self.c_pos)
+
+    def values_at(self, i, j):
+        if self.residual is None:
+            x = np.zeros(len(i))
+        else:
+            x = np.array(self.residual.values_at(i, j), dtype = np.float64)
+        p, q = self.r_pos[i], self.c_pos[j]
+        for blocks, val in [(self.neg, -np.inf), (self.pos, np.inf)]:
+            for r_0, r_1, c_0, c_1 in blocks:
+                x[(r_0 <= p) & (p < r_1) & (c_0 <= q) & (q < c_1)] = val
+        return x
+
+    # Rows and columns of the subset keep their relative order, so the
+    # blocks remain contiguous ranges in the restricted permutations
+    def _restrict(self, rinds, cinds, residual):
+        rinds = np.arange(len(self.rnames))[rinds]
+        cinds = np.arange(len(self.cnames))[cinds]
+        p, q = self.r_pos[rinds], self.c_pos[cinds]
+        r_ord = np.argsort(p, kind = 'mergesort')
+        c_ord = np.argsort(q, kind = 'mergesort')
+        p, q = p[r_ord], q[c_ord]
+
+        def restrict(blocks):
+            sub_blocks = []
+            for r_0, r_1, c_0, c_1 in blocks:
+                r_0, r_1 = np.searchsorted(p, [r_0, r_1])
+                c_0, c_1 = np.searchsorted(q, [c_0, c_1])
+                if r_1 > r_0 and c_1 > c_0:
+                    sub_blocks.append((r_0, r_1, c_0, c_1))
+            return sub_blocks
+
+        return BlockOffset(self.rnames[rinds], self.cnames[cinds],
+                           r_ord, c_ord, restrict(self.neg),
+                           restrict(self.pos), restrict(self.active),
+                           residual)
+
+    def subset(self, rinds, cinds):
+        residual = self.residual
+        if not residual is None:
+            residual = residual.subset(rinds, cinds)
+        return self._restrict(rinds, cinds, residual)
+
+    def view(self, rinds, cinds):
+        residual = self.residual
+        if not residual is None:
+            residual = residual.view(rinds, cinds)
+        return self._restrict(rinds, cinds, residual)
+
+    def from_binary_function_name(self, f):
+        self.flatten()
+        self.residual.from_binary_function_name(f)
+        self.dirty()
+
+    def from_binary_function_ind(self, f):
+        self.flatten()
+        self.residual.from_binary_function_ind(f)
+        self.dirty()
+
+    def from_matrix(self, x):
+        self.flatten()
+        self.residual.from_matrix(x)
+        self.dirty()
+
+    def _fill_rows(self, f_block):
+        self.flatten()
+        self.residual._fill_rows(f_block)
+        self.dirty()
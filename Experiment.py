@@ -54,7 +54,9 @@ class RandomSubnetworks:
                 self.neighbors = { n: list(neighbors[n]) for n in neighbors }
                 self.num_nodes = len(self.neighbors)
 
-    def sample(self, as_network = False):
+    # With view = True, the samples are (copy-on-write) views of the
+    # base network; see Array.subarray
+    def sample(self, as_network = False, view = False):
         M = self.network.M
         N = self.network.N
         s = self.train_size
@@ -62,11 +64,11 @@ class RandomSubnetworks:
         def produce(r, c):
             if as_network:
                 inds = np.unique(np.array(list(r) + list(c)))
-                return self.network.subnetwork(inds)
+                return self.network.subnetwork(inds, view)
             else:
                 r_a = np.array(list(r))
                 r_c = np.array(list(c))
-                return self.network.subarray(r_a, r_c)
+                return self.network.subarray(r_a, r_c, view)
 
         def fallback():
             s_r, s_c = s
@@ -6,18 +6,22 @@
 from __future__ import division
 import numpy as np
 import scipy.optimize as opt
+import scipy.sparse as sparse
 from scipy.stats import norm
 from scipy.linalg import inv, solve
 from time import time
 from itertools import permutations
 
 from Utility import logit, inv_logit, logit_mean, tree, lift_tree, digest
+from Utility import row_blocks, log1pexp, pcg, l2, LabeledMatrix
 from BinaryMatrix import arbitrary_from_margins
 from BinaryMatrix import approximate_from_margins_weights as acsample
 from BinaryMatrix import approximate_conditional_nll as acnll
 from BinaryMatrix import log_p_margins_saddlepoint
 from BinaryMatrix import log_partition_is
 from Confidence import ci_conservative_generic
+from Covariate import BlockOffset, BlockEffectOffset
+from Storage import PackedMatrix
 
 # See if embedded R process can be started; this should be done once,
 # globally, to reduce overhead.
@@ -64,13 +68,116 @@ class IndependentBernoulli:
             else:
                 return np.tile(0.5, (M, N))
 
+    # Streaming evaluation: the logits (or probabilities) in blocks of
+    # consecutive rows, as (start, stop, block) triples, with at most
+    # (roughly) max_cells cells in each block. Nothing of size M x N is
+    # ever held, so this works for networks whose dense arrays would
+    # not fit in memory; see also the reductions below.
+    def edge_probability_blocks(self, network, ignore_offset = False,
+                                logit = False, max_cells = 2 ** 20):
+        logit_rows = self._logit_rows(network, ignore_offset)
+        for start, stop in row_blocks(network.M, network.N, max_cells):
+            logit_P = logit_rows(start, stop)
+            if logit:
+                yield start, stop, logit_P
+            else:
+                yield start, stop, inv_logit(logit_P)
+
+    # Function giving the (freshly allocated) logits for the rows
+    # start:stop, for the streaming evaluation above
+    def _logit_rows(self, network, ignore_offset):
+        N = network.N
+        if (not ignore_offset) and network.offset:
+            offset = network.offset
+            return lambda start, stop: \
+              np.array(offset.rows(start, stop), dtype = np.float64)
+        else:
+            return lambda start, stop: np.zeros((stop - start, N))
+
+    # Reductions over the streamed probabilities: expected row and
+    # column margins, and expected totals of the named edge covariates
+    def expected_margins(self, network, ignore_offset = False,
+                         max_cells = 2 ** 20):
+        Er, Ec = np.zeros(network.M), np.zeros(network.N)
+        for start, stop, P in \
+          self.edge_probability_blocks(network, ignore_offset,
+                                       max_cells = max_cells):
+            Er[start:stop] = P.sum(1)
+            Ec += P.sum(0)
+        return Er, Ec
+
+    def expected_covariate_statistics(self, network, cov_names,
+                                      ignore_offset = False,
+                                      max_cells = 2 ** 20):
+        covs = [network.edge_covariates[n] for n in cov_names]
+        Ex = np.zeros(len(covs))
+        for start, stop, P in \
+          self.edge_probability_blocks(network, ignore_offset,
+                                       max_cells = max_cells):
+            for b, x_b in enumerate(covs):
+                Ex[b] += x_b.dot(P, start)
+        return Ex
+
+    # Negative log-likelihood, as nll() but accumulated over the
+    # streamed logits and the matching rows of the adjacency data
+    def streamed_nll(self, network, ignore_offset = False,
+                     max_cells = 2 ** 20):
+        A = network.array
+        nll = 0.0
+        for start, stop, log_Q in \
+          self.edge_probability_blocks(network, ignore_offset, logit = True,
+                                       max_cells = max_cells):
+            if sparse.issparse(A):
+                A_block = A[start:stop].toarray() != 0
+            else:
+                A_block = np.asarray(A[start:stop]) != 0
+
+            log_Q_neg_inf = log_Q == -np.inf
+            log_Q_pos_inf = log_Q ==  np.inf
+            if np.any(A_block[log_Q_neg_inf]) or \
+              np.any(~A_block[log_Q_pos_inf]):
+                return np.Inf
+            log_Q_rest = ~(log_Q_neg_inf | log_Q_pos_inf)
+            nll += log1pexp(log_Q[log_Q_rest]).sum()
+            nll -= log_Q[log_Q_rest & A_block].sum()
+        return nll
+
+    # Fisher information for (kappa, beta_1, ..., beta_B), for the
+    # named edge covariates, accumulated over the streamed
+    # probabilities, along with the row and column sums of the weights
+    # W = P (1 - P) (the diagonal information for row and column
+    # effects). Cells with probability 0 or 1 carry no information.
+    def fisher_information_blocks(self, network, cov_names,
+                                  ignore_offset = False,
+                                  max_cells = 2 ** 20):
+        covs = [network.edge_covariates[n] for n in cov_names]
+        B = len(covs)
+        I = np.zeros((1 + B, 1 + B))
+        W_r, W_c = np.zeros(network.M), np.zeros(network.N)
+        for start, stop, P in \
+          self.edge_probability_blocks(network, ignore_offset,
+                                       max_cells = max_cells):
+            W = P * (1.0 - P)
+            W_r[start:stop] = W.sum(1)
+            W_c += W.sum(0)
+            if B == 0:
+                continue
+            x = np.empty((1 + B, W.size))
+            x[0] = 1.0
+            for b, x_b in enumerate(covs):
+                x[1 + b] = x_b.rows(start, stop).reshape(-1)
+            I += np.dot(x * W.reshape(-1), x.T)
+        I[0,0] = W_r.sum()
+        return I, W_r, W_c
+
     def nll(self, network, submatrix = None, ignore_offset = False):
+        if not submatrix:
+            return self.streamed_nll(network, ignore_offset)
+
         log_Q = self.edge_probabilities(network, submatrix, ignore_offset,
                                         logit = True)
-        A = network.as_dense()
-        if submatrix:
-            i_sub, j_sub = submatrix
-            A = A[i_sub][:,j_sub]
+        i_sub, j_sub = submatrix
+        A = network.as_dense()[i_sub][:,j_sub]
 
         # Check for impossible data for the cells with 0/1 probabilities
         log_Q_neg_inf = log_Q == -np.inf
@@ -116,9 +223,9 @@ class IndependentBernoulli:
         M = network.M
         N = network.N
         if r is None:
-            r = network.as_dense().sum(1)
+            r = network.margins()[0]
         if c is None:
-            c = network.as_dense().sum(0)
+            c = network.margins()[1]
 
         if arbitrary_init:
             # Initialize from an arbitrary matrix with the requested margins
@@ -306,6 +413,166 @@ class Stationary(IndependentBernoulli):
         else:
             return inv_logit(logit_P)
 
+    # The linear predictor (apart from the offset) as row effects,
+    # column effects, and (coefficient, edge covariate) pairs. The
+    # sparse evaluation code below works from these, never forming
+    # the full M x N array of logits at once.
+    def _predictor_terms(self, network):
+        return np.tile(self.kappa, network.M), np.zeros(network.N), []
+
+    # Blocks of cells over which the model needs to be evaluated, as
+    # (rows, cols) pairs: blocks of consecutive rows (a slice, with
+    # cols None for all columns) or, if the offset is a BlockOffset,
+    # pieces of its active rectangles (index arrays). The cells outside
+    # these are fixed at -inf/+inf and are never visited.
+    def _eval_blocks(self, network, use_offset):
+        if use_offset and isinstance(network.offset, BlockOffset):
+            for rinds, cinds in network.offset.active_rectangles():
+                for start, stop in row_blocks(len(rinds), len(cinds)):
+                    yield rinds[start:stop], cinds
+        else:
+            for start, stop in row_blocks(network.M, network.N):
+                yield slice(start, stop), None
+
+    def _logit_rows(self, network, ignore_offset):
+        use_offset = (not ignore_offset) and network.offset
+        terms = self._predictor_terms(network)
+        return lambda start, stop: \
+          self._logit_block(network, terms, slice(start, stop), None,
+                            use_offset)
+
+    def _logit_block(self, network, terms, rows, cols, use_offset):
+        a, b, x = terms
+        if cols is None:
+            values = lambda cov: cov.rows(rows.start, rows.stop)
+        else:
+            values = lambda cov: cov.take(rows, cols)
+            b = b[cols]
+        logit_P = a[rows].reshape((-1,1)) + b.reshape((1,-1))
+        if use_offset:
+            logit_P += values(network.offset)
+        for beta_b, x_b in x:
+            logit_P += beta_b * values(x_b)
+        return logit_P
+
+    def _logit_cells(self, network, terms, i, j, use_offset):
+        a, b, x = terms
+        logit_P = a[i] + b[j]
+        if use_offset:
+            logit_P += network.offset.values_at(i, j)
+        for beta_b, x_b in x:
+            logit_P += beta_b * x_b.values_at(i, j)
+        return logit_P
+
+    # Sum of log(1 + exp(logit_P)) over the cells with finite logits,
+    # along with the number of cells with logit_P = +inf
+    def _log_partition(self, network, terms, use_offset):
+        a, b, x = terms
+        if len(x) == 0 and not use_offset:
+            # Logits are sums of row and column effects, so only
+            # distinct pairs of effects need to be evaluated
+            return log_partition_factored(a, b), 0
+
+        log_kappa, pos_inf = 0.0, 0
+        if use_offset and isinstance(network.offset, BlockOffset):
+            pos_inf += network.offset.pos_inf_count()
+        for rows, cols in self._eval_blocks(network, use_offset):
+            logit_P = self._logit_block(network, terms, rows, cols,
+                                        use_offset)
+            if use_offset:
+                finite = np.isfinite(logit_P)
+                pos_inf += (logit_P == np.inf).sum()
+                logit_P = logit_P[finite]
+            log_kappa += log1pexp(logit_P).sum()
+        return log_kappa, pos_inf
+
+    # Negative log-likelihood from the sparse adjacency matrix: the
+    # data term costs O(nnz) and the log-partition term is evaluated
+    # in blocks of rows (or from the row/column factorization).
+    def nll(self, network, submatrix = None, ignore_offset = False):
+        if submatrix:
+            return IndependentBernoulli.nll(self, network, submatrix,
+                                            ignore_offset)
+
+        use_offset = (not ignore_offset) and network.offset
+        terms = self._predictor_terms(network)
+
+        i, j = network.array.nonzero()
+        log_Q_A = self._logit_cells(network, terms, i, j, use_offset)
+
+        # Check for impossible data for the cells with 0/1 probabilities
+        if np.any(log_Q_A == -np.inf):
+            return np.Inf
+        A_pos_inf = (log_Q_A == np.inf)
+        log_kappa, pos_inf = self._log_partition(network, terms, use_offset)
+        if pos_inf != A_pos_inf.sum():
+            return np.Inf
+
+        return log_kappa - log_Q_A[~A_pos_inf].sum()
+
+    # Observed sufficient statistics: edge covariate totals over the
+    # edges, row sums and column sums
+    def _sufficient_statistics(self, network):
+        a, b, x = self._predictor_terms(network)
+        if len(x) > 0:
+            i, j = network.array.nonzero()
+        Tx = np.array([x_b.values_at(i, j).sum() for beta_b, x_b in x])
+        r, c = network.margins()
+        return Tx, r, c
+
+    # Expected values of the above, under the current parameters
+    def _expected_statistics(self, network, covariates = True):
+        M = network.M
+        N = network.N
+        use_offset = bool(network.offset)
+        terms = self._predictor_terms(network)
+        x = terms[2]
+
+        Ex = np.zeros(len(x))
+        Er = np.zeros(M)
+        Ec = np.zeros(N)
+        for rows, cols in self._eval_blocks(network, use_offset):
+            logit_P = self._logit_block(network, terms, rows, cols,
+                                        use_offset)
+            P = inv_logit(logit_P)
+            Er[rows] += P.sum(1)
+            if cols is None:
+                Ec += P.sum(0)
+            else:
+                Ec[cols] += P.sum(0)
+            if covariates:
+                for b, (beta_b, x_b) in enumerate(x):
+                    if cols is None:
+                        Ex[b] += x_b.dot(P, rows.start)
+                    else:
+                        Ex[b] += (P * x_b.take(rows, cols)).sum()
+
+        # Cells fixed at +inf by a BlockOffset have P = 1
+        if use_offset and isinstance(network.offset, BlockOffset):
+            for rinds, cinds in network.offset.pos_rectangles():
+                Er[rinds] += len(cinds)
+                Ec[cinds] += len(rinds)
+                if not covariates:
+                    continue
+                for start, stop in row_blocks(len(rinds), len(cinds)):
+                    for b, (beta_b, x_b) in enumerate(x):
+                        Ex[b] += x_b.take(rinds[start:stop], cinds).sum()
+        return Ex, Er, Ec
+
+    # Row-wise, column-wise and overall logit_mean of the offset
+    def _offset_logit_means(self, network):
+        M = network.M
+        N = network.N
+
+        P_r = np.empty(M)
+        P_c = np.zeros(N)
+        for start, stop in row_blocks(M, N):
+            P = inv_logit(network.offset.rows(start, stop))
+            P_r[start:stop] = P.mean(1)
+            P_c += P.sum(0)
+        P_c /= M
+        return logit(P_r.mean()), logit(P_r), logit(P_c)
+
     def match_kappa(self, network, kappa_target):
         M = network.M
         N = network.N
@@ -318,8 +585,7 @@ class Stationary(IndependentBernoulli):
         target, val = kappa_target
         def obj(kappa):
             self.kappa = kappa
-            P = self.edge_probabilities(network)
-            exp_edges = P.sum()
+            exp_edges = self.expected_margins(network)[0].sum()
             if target == 'sum':
                 return abs(exp_edges - val)
             elif target in 'row_sum':
@@ -343,61 +609,51 @@ class Stationary(IndependentBernoulli):
         
         # Calculate observed sufficient statistic
         T = np.empty(1)
-        A = network.as_dense()
-        T[0] = A.sum(dtype=np.int)
+        T[0] = self._sufficient_statistics(network)[1].sum()
 
         theta = np.empty(1)
-        theta[0] = logit(A.sum(dtype=np.int) / (1.0 * network.M * network.N))
+        theta[0] = logit(T[0] / (1.0 * network.M * network.N))
         if network.offset:
-            theta[0] -= logit_mean(network.offset.matrix())
-        def obj(theta):
+            theta[0] -= self._offset_logit_means(network)[0]
+        design = CompiledDesign(self, network, [])
+
+        # Objective and gradient, from one pass over the cells
+        def obj_grad(theta):
             if np.any(np.isnan(theta)):
                 print 'Warning: computing objective for nan-containing vector.'
-                return np.Inf
-            self.kappa = theta[0]
-            nll = self.nll(network)
-            self.fit_info['nll_evals'] += 1
-            return nll
-        def grad(theta):
-            if np.any(np.isnan(theta)):
-                print 'Warning: computing gradient for nan-containing vector.'
-                return np.zeros(1)
-            self.kappa = theta[0]
+                return np.Inf, np.zeros(1)
+            nll, Ex, Er, Ec = design.evaluate(theta)
             ET = np.empty(1)
-            P = self.edge_probabilities(network)
-            ET[0] = P.sum()
+            ET[0] = Er.sum()
             grad = ET - T
+            self.fit_info['nll_evals'] += 1
             self.fit_info['grad_nll_evals'] += 1
             self.fit_info['grad_nll_final'][:] = grad
             if verbose:
                 print '|ET - T|: %.2f' % abs(grad[0])
-            return grad
+            return nll, grad
 
         bounds = [(-15,15)]
-        theta_opt = opt.fmin_l_bfgs_b(obj, theta, grad, bounds = bounds)[0]
+        theta_opt = opt.fmin_l_bfgs_b(obj_grad, theta, bounds = bounds)[0]
         self.kappa = theta_opt[0]
 
         self.fit_info['wall_time'] = time() - start_time
 
+    # All cells share the one covariate (the intercept), so pooling
+    # leaves a row per distinct offset value
     def fit_logistic(self, network):
-        import statsmodels.api as sm
-
-        M = network.M
-        N = network.N
-
-        y = network.as_dense().reshape((M*N,))
-        Phi = np.zeros((M*N,1))
-        Phi[:,0] = 1.0
+        X, y, n, offset = pool_network_cells(network, [],
+                                             bool(network.offset))
+        Phi = np.ones((X.shape[0],1))
 
         try:
-            if network.offset:
-                offset = network.offset.matrix().reshape((M*N,))
-                fit = sm.GLM(y, Phi, sm.families.Binomial(), offset).fit()
-            else:
-                fit = sm.Logit(y, Phi).fit()
-            coefs = fit.params
+            coefs, converged = fit_binomial_logit(Phi, y, n, offset)
+            self.fit_info['converged'] = converged
+            if not converged:
+                print 'Warning: logistic fit did not converge.'
         except:
             print 'Warning: logistic fit failed.'
+            self.fit_info['converged'] = False
             coefs = np.zeros(1)
 
         self.kappa = coefs[0]
@@ -405,6 +661,577 @@ class Stationary(IndependentBernoulli):
     def reset_confidence(self):
         self.conf = tree()
 
+# Sum of log(1 + exp(a_i + b_j)) over all cells, from the distinct
+# values of the row and column effects
+def log_partition_factored(a, b):
+    a_u, a_n = np.unique(a, return_counts = True)
+    b_u, b_n = np.unique(b, return_counts = True)
+    log_kappa = 0.0
+    for start, stop in row_blocks(len(a_u), len(b_u)):
+        logit_P = a_u[start:stop].reshape((-1,1)) + b_u.reshape((1,-1))
+        log_kappa += np.dot(a_n[start:stop], np.dot(log1pexp(logit_P), b_n))
+    return log_kappa
+
+# Maximum likelihood logistic regression on grouped binomial data (y
+# successes out of n trials for each row of the design X, which may be
+# a scipy.sparse matrix), by iteratively reweighted least squares. Only
+# the (P, P) normal equations are formed densely, so indicator columns
+# stay cheap however many cells there are. Steps are halved until the
+# nll does not increase, and the fit has converged once the largest
+# change to the coefficients is below tol. If instead the nll stops
+# improving while the coefficients are still moving by more than
+# sqrt(tol) (as they do without bound when the data are separated), or
+# max_iter is reached, iteration stops and the fit is flagged as not
+# converged.
+#
+# With bounds (lower, upper) on the coefficients, steps are clipped to
+# them and coefficients held at a bound by the gradient are left out
+# of the step, so separated data give the bounded optimum instead.
+# Returns the coefficients and whether the fit converged.
+def fit_binomial_logit(X, y, n, offset = None, tol = 1e-6, max_iter = 100,
+                       lower = None, upper = None):
+    X = sparse.csr_matrix(X)
+    P = X.shape[1]
+    if offset is None:
+        offset = np.zeros(X.shape[0])
+    if lower is None:
+        lower, upper = np.tile(-np.inf, P), np.tile(np.inf, P)
+
+    def nll_at(coefs):
+        logit_P = X.dot(coefs) + offset
+        return np.sum(n * log1pexp(logit_P)) - np.dot(y, logit_P), logit_P
+
+    coefs = np.clip(np.zeros(P), lower, upper)
+    nll, logit_P = nll_at(coefs)
+    for it in range(max_iter):
+        p = inv_logit(logit_P)
+        W = sparse.diags(n * p * (1.0 - p))
+        XtWX = (X.T * W * X).toarray()
+        score = X.T.dot(y - n * p)
+        free = ~(((coefs <= lower) & (score < 0)) |
+                 ((coefs >= upper) & (score > 0)))
+        XtWX = XtWX[free][:,free]
+        delta = np.zeros(P)
+        try:
+            delta[free] = solve(XtWX, score[free], sym_pos = True)
+        except np.linalg.LinAlgError:
+            delta[free] = np.linalg.lstsq(XtWX, score[free],
+                                          rcond = None)[0]
+        if np.abs(delta).max() < tol:
+            return np.clip(coefs + delta, lower, upper), True
+
+        t = 1.0
+        for ls in range(30):
+            coefs_new = np.clip(coefs + t * delta, lower, upper)
+            nll_new, logit_P_new = nll_at(coefs_new)
+            if nll_new <= nll + 1e-12 * (abs(nll) + 1.0):
+                break
+            t /= 2.0
+        else:
+            return coefs, False
+        step = coefs_new - coefs
+        coefs = coefs_new
+        nll_old, nll, logit_P = nll, nll_new, logit_P_new
+        if np.abs(step).max() < tol:
+            return coefs, True
+        if nll_old - nll <= 1e-12 * (abs(nll) + 1.0):
+            return coefs, np.abs(step).max() < np.sqrt(tol)
+
+    return coefs, False
+
+# Pool cells into grouped binomial data for fit_binomial_logit: cells
+# with identical covariate values (the columns) and offset share a row,
+# with their edges counted as successes. Cells with infinite offset
+# carry no information about the parameters, so are dropped. Rows that
+# are already pooled can be pooled again by giving their trials. Returns
+# the design (without intercept), successes, trials, and offset (None
+# if there was none).
+def pool_cells(columns, y, offset = None, trials = None):
+    if trials is None:
+        trials = np.ones(len(y))
+    if offset is not None:
+        keep = np.isfinite(offset)
+        columns = [x[keep] for x in columns] + [offset[keep]]
+        y = y[keep]
+        trials = trials[keep]
+    C = len(columns)
+    if C == 0:
+        return (np.zeros((1,0)), np.array([np.sum(y)]),
+                np.array([np.sum(trials)]), None)
+
+    keys = np.column_stack(columns)
+    keys, group = np.unique(keys, axis = 0, return_inverse = True)
+    G = keys.shape[0]
+    successes = np.bincount(group, weights = y, minlength = G)
+    trials = np.bincount(group, weights = trials, minlength = G)
+    if offset is None:
+        return keys, successes, trials, None
+    return keys[:,0:(C-1)], successes, trials, keys[:,C-1]
+
+# As pool_cells, for the named edge covariates (and, with use_offset,
+# the offset) of a network, pooling a block of rows at a time and then
+# pooling the blocks together, so that no (M*N, B) design is formed.
+def pool_network_cells(network, cov_names, use_offset = False,
+                       max_cells = 2 ** 20):
+    covs = [network.edge_covariates[n] for n in cov_names]
+    A = network.array
+    blocks = []
+    for start, stop in row_blocks(network.M, network.N, max_cells):
+        if sparse.issparse(A):
+            y = A[start:stop].toarray() != 0
+        else:
+            y = np.asarray(A[start:stop]) != 0
+        x = [x_b.rows(start, stop).reshape(-1) for x_b in covs]
+        offset = None
+        if use_offset:
+            offset = network.offset.rows(start, stop).reshape(-1)
+        blocks.append(pool_cells(x, y.reshape(-1).astype(np.float), offset))
+
+    X = np.vstack([X_b for X_b, y_b, n_b, o_b in blocks])
+    y = np.concatenate([y_b for X_b, y_b, n_b, o_b in blocks])
+    n = np.concatenate([n_b for X_b, y_b, n_b, o_b in blocks])
+    offset = None
+    if use_offset:
+        offset = np.concatenate([o_b for X_b, y_b, n_b, o_b in blocks])
+    return pool_cells(list(X.T), y, offset, n)
+
+# Sparse design for a logistic fit of a network with row and column
+# effects, in the layout of CompiledDesign (covariates, intercept, the
+# first M-1 row and N-1 column indicators), with the response and the
+# offset (None if use_offset is not set). Built a block of rows at a
+# time, with cells at infinite offset (which carry no information
+# about the parameters) dropped, so that no dense array over all the
+# cells is formed.
+def network_design(network, cov_names, use_offset = False,
+                   max_cells = 2 ** 20):
+    M, N = network.M, network.N
+    covs = [network.edge_covariates[n] for n in cov_names]
+    B = len(covs)
+    A = network.array
+    X_blocks, y_blocks, o_blocks = [], [], []
+    for start, stop in row_blocks(M, N, max_cells):
+        if sparse.issparse(A):
+            y = A[start:stop].toarray() != 0
+        else:
+            y = np.asarray(A[start:stop]) != 0
+        y = y.reshape(-1).astype(np.float)
+        i = np.repeat(np.arange(start, stop), N)
+        j = np.tile(np.arange(N), stop - start)
+        keep = None
+        if use_offset:
+            offset = network.offset.rows(start, stop).reshape(-1)
+            keep = np.isfinite(offset)
+            o_blocks.append(offset[keep])
+            y, i, j = y[keep], i[keep], j[keep]
+        x = np.ones((len(y),B + 1))
+        for b, x_b in enumerate(covs):
+            x_b = x_b.rows(start, stop).reshape(-1)
+            x[:,b] = x_b if keep is None else x_b[keep]
+        X_x = sparse.csr_matrix(x)
+        r, c = i < (M-1), j < (N-1)
+        cells = np.arange(len(y))
+        X_r = sparse.csr_matrix((np.ones(r.sum()), (cells[r], i[r])),
+                                shape = (len(y),M-1))
+        X_c = sparse.csr_matrix((np.ones(c.sum()), (cells[c], j[c])),
+                                shape = (len(y),N-1))
+        X_blocks.append(sparse.hstack([X_x, X_r, X_c], format = 'csr'))
+        y_blocks.append(y)
+
+    X = sparse.vstack(X_blocks, format = 'csr')
+    y = np.concatenate(y_blocks)
+    offset = None
+    if use_offset:
+        offset = np.concatenate(o_blocks)
+    return X, y, offset
+
+# The linear predictor of a Stationary-family model on a network,
+# compiled once for the repeated evaluations made while fitting. The
+# parameters are a flat vector theta, laid out as
+#
+#   [beta_1, ..., beta_B, kappa, alpha_out_1, ..., alpha_out_{M-1},
+#    alpha_in_1, ..., alpha_in_{N-1}]
+#
+# where the alpha parts are only present if row_col is set (the last
+# row and column effects are held at their values when compiled).
+#
+# The evaluation blocks (see Stationary._eval_blocks) are fixed, along
+# with the offset and the edge covariates over each, stacked as a
+# (B, cells) array per block if they fit in max_cached_cells values,
+# and otherwise read into preallocated buffers as each block is
+# visited, so that memory use stays bounded by the block size. Logits
+# are then formed by one product of beta with the stack, into a
+# preallocated buffer. Everything that does not depend on theta
+# (statistics over the edges, the cells fixed at -inf/+inf by the
+# offset) is worked out here too.
+#
+# Cells with offset +inf are excluded from the log-partition term (the
+# data must have edges at all of them, or the likelihood is zero), so
+# are compiled to -inf, which contributes nothing, and only have P = 1
+# restored; cells at -inf need no special handling.
+class CompiledDesign:
+    def __init__(self, model, network, cov_names, row_col = False,
+                 max_cached_cells = 2 ** 25):
+        M, N = network.M, network.N
+        B = len(cov_names)
+        self.M, self.N, self.B = M, N, B
+        self.row_col = row_col
+        covs = [network.edge_covariates[n] for n in cov_names]
+        self.use_offset = use_offset = bool(network.offset)
+        offset = network.offset
+
+        if row_col:
+            self.a_fixed = network.row_covariates['alpha_out'][:].copy()
+            self.b_fixed = network.col_covariates['alpha_in'][:].copy()
+        else:
+            self.a_fixed = np.zeros(M)
+            self.b_fixed = np.zeros(N)
+        self.a = np.empty(M)
+        self.b = np.empty(N)
+
+        # Evaluation blocks, as (rows, cols, offset, covariate stack,
+        # flat indices of the cells with offset +inf, or None)
+        blocks = list(model._eval_blocks(network, use_offset))
+        n_cells = sum([self._block_size(rows, cols)
+                       for rows, cols in blocks])
+        self.cache = ((B + use_offset) * n_cells <= max_cached_cells)
+        self.covs = covs
+        self.offset = offset
+        self.blocks = []
+        self.pos_inf = 0
+        max_size = 1
+        for rows, cols in blocks:
+            size = self._block_size(rows, cols)
+            max_size = max(max_size, size)
+            off, pos_inds, x = None, None, None
+            if use_offset:
+                off, pos_inds = self._offset_block(rows, cols)
+                if not pos_inds is None:
+                    self.pos_inf += len(pos_inds)
+            if self.cache:
+                x = self._stack(rows, cols, np.empty((B, size)))
+            else:
+                off, pos_inds = None, None
+            self.blocks.append((rows, cols, off, x, pos_inds))
+        self.buf = np.empty(max_size)
+        self.P_buf = np.empty(max_size)
+        self.work_buf = np.empty(max_size)
+        if not self.cache:
+            self.x_buf = np.empty((B, max_size))
+
+        # Cells fixed at +inf by a BlockOffset, which have P = 1
+        self.Ex_pos = np.zeros(B)
+        self.Er_pos = np.zeros(M)
+        self.Ec_pos = np.zeros(N)
+        if use_offset and isinstance(offset, BlockOffset):
+            self.pos_inf += offset.pos_inf_count()
+            for rinds, cinds in offset.pos_rectangles():
+                self.Er_pos[rinds] += len(cinds)
+                self.Ec_pos[cinds] += len(rinds)
+                for start, stop in row_blocks(len(rinds), len(cinds)):
+                    for b, x_b in enumerate(covs):
+                        self.Ex_pos[b] += \
+                          x_b.take(rinds[start:stop], cinds).sum()
+
+        # Statistics over the edges with finite offset, for the data
+        # term of the likelihood, and whether the data are possible
+        # at all given the cells fixed at -inf/+inf
+        i, j = network.array.nonzero()
+        self.feasible = True
+        self.off_edges = 0.0
+        if use_offset:
+            off_e = offset.values_at(i, j)
+            edge_pos_inf = (off_e == np.inf)
+            if (np.any(off_e == -np.inf) or
+                edge_pos_inf.sum() != self.pos_inf):
+                self.feasible = False
+            i, j = i[~edge_pos_inf], j[~edge_pos_inf]
+            self.off_edges = off_e[~edge_pos_inf].sum()
+        self.Tx_edges = np.array([x_b.values_at(i, j).sum() for x_b in covs])
+        self.r_edges = np.bincount(i, minlength = M)
+        self.c_edges = np.bincount(j, minlength = N)
+
+    def _block_size(self, rows, cols):
+        if cols is None:
+            return (rows.stop - rows.start) * self.N
+        else:
+            return len(rows) * len(cols)
+
+    def _values(self, cov, rows, cols):
+        if cols is None:
+            return cov.rows(rows.start, rows.stop)
+        else:
+            return cov.take(rows, cols)
+
+    # Offset over a block, flattened, with cells at +inf moved to -inf
+    # (see above), and the indices of those cells (None if none)
+    def _offset_block(self, rows, cols):
+        off = np.array(self._values(self.offset, rows, cols),
+                       dtype = np.float64).reshape(-1)
+        pos_inds = np.flatnonzero(off == np.inf)
+        if len(pos_inds) == 0:
+            return off, None
+        off[pos_inds] = -np.inf
+        return off, pos_inds
+
+    def _stack(self, rows, cols, out):
+        size = self._block_size(rows, cols)
+        for b, x_b in enumerate(self.covs):
+            out[b,0:size] = self._values(x_b, rows, cols).reshape(-1)
+        return out[:,0:size]
+
+    # Row effects (including kappa) and column effects from theta, in
+    # preallocated arrays, along with beta
+    def unpack(self, theta):
+        M, N, B = self.M, self.N, self.B
+        a, b = self.a, self.b
+        a[:] = self.a_fixed
+        b[:] = self.b_fixed
+        if self.row_col:
+            a[0:(M-1)] = theta[(B + 1):(B + 1 + (M-1))]
+            b[0:(N-1)] = theta[(B + 1 + (M-1)):(B + 1 + (M-1) + (N-1))]
+        a += theta[B]
+        return a, b, theta[0:B]
+
+    # Logits over each evaluation block in turn, as (rows, cols, logits,
+    # covariate stack, indices of cells at +inf); the logits are
+    # written over the same buffer for every block, so must be used
+    # before moving on
+    def block_logits(self, theta):
+        a, b, beta = self.unpack(theta)
+        for rows, cols, off, x, pos_inds in self.blocks:
+            if not self.cache:
+                x = self._stack(rows, cols, self.x_buf)
+                if self.use_offset:
+                    off, pos_inds = self._offset_block(rows, cols)
+            size = x.shape[1]
+            logit_P = self.buf[0:size]
+            if self.B > 0:
+                np.dot(beta, x, out = logit_P)
+            else:
+                logit_P[:] = 0.0
+            logit_P = logit_P.reshape((-1, self.N if cols is None
+                                           else len(cols)))
+            logit_P += a[rows].reshape((-1,1))
+            if cols is None:
+                logit_P += b.reshape((1,-1))
+            else:
+                logit_P += b[cols].reshape((1,-1))
+            if not off is None:
+                logit_P += off.reshape(logit_P.shape)
+            yield rows, cols, logit_P, x, pos_inds
+
+    # Negative log-likelihood and the expected sufficient statistics
+    # (covariate totals, row sums and column sums), from which its
+    # gradient follows, in one pass over the cells. Per cell, with
+    # e = exp(-|logit_P|),
+    #
+    #   log(1 + exp(logit_P)) = max(logit_P, 0) + log(1 + e)
+    #   P = e / (1 + e), or 1 - e / (1 + e) for logit_P >= 0
+    #
+    # all computed in preallocated buffers.
+    def evaluate(self, theta, gradient = True, covariates = True):
+        a, b, beta = self.unpack(theta)
+        data_term = (np.dot(beta, self.Tx_edges) + np.dot(a, self.r_edges) +
+                     np.dot(b, self.c_edges) + self.off_edges)
+
+        if self.B == 0 and not self.use_offset and not gradient:
+            return log_partition_factored(a, b) - data_term, None, None, None
+
+        log_kappa = 0.0
+        Ex = self.Ex_pos.copy()
+        Er = self.Er_pos.copy()
+        Ec = self.Ec_pos.copy()
+        for rows, cols, logit_P, x, pos_inds in self.block_logits(theta):
+            shape = logit_P.shape
+            e = self.work_buf[0:logit_P.size].reshape(shape)
+            P = self.P_buf[0:logit_P.size].reshape(shape)
+            np.abs(logit_P, out = e)
+            np.negative(e, out = e)
+            np.exp(e, out = e)
+            log_kappa += np.maximum(logit_P, 0, out = P).sum()
+            log_kappa += np.log1p(e, out = P).sum()
+            if not gradient:
+                continue
+
+            np.add(e, 1.0, out = P)
+            np.divide(e, P, out = P)
+            np.subtract(1.0, P, out = P, where = (logit_P >= 0))
+            if not pos_inds is None:
+                P.reshape(-1)[pos_inds] = 1.0
+            Er[rows] += P.sum(1)
+            if cols is None:
+                Ec += P.sum(0)
+            else:
+                Ec[cols] += P.sum(0)
+            if covariates and self.B > 0:
+                Ex += np.dot(x, P.reshape(-1))
+
+        if not self.feasible:
+            nll = np.Inf
+        else:
+            nll = log_kappa - data_term
+        if not gradient:
+            return nll, None, None, None
+        return nll, Ex, Er, Ec
+
+    def nll(self, theta):
+        return self.evaluate(theta, gradient = False)[0]
+
+    def expected_statistics(self, theta, covariates = True):
+        return self.evaluate(theta, covariates = covariates)[1:]
+
+    # Covariate totals, row sums and column sums, in the layout of theta
+    def pack(self, x, r, c):
+        M, N, B = self.M, self.N, self.B
+        if not self.row_col:
+            return np.concatenate([x, [r.sum()]])
+        return np.concatenate([x, [r.sum()], r[0:(M-1)], c[0:(N-1)]])
+
+    # The Hessian of the NLL is the information X^T W X, for the design
+    # X (with columns for the covariates, kappa, and row and column
+    # indicators) and the cell weights W = P (1 - P). It is never
+    # formed: set_curvature() fixes W at theta, returning the diagonal
+    # of the Hessian, and hessian_vector() then gives products with it
+    # in one pass over the cells. The weights are kept for the products
+    # if the design is cached, and recomputed in each pass otherwise.
+    def set_curvature(self, theta):
+        self.W_theta = theta.copy()
+        self.W_blocks = []
+        Dx = np.zeros(self.B)
+        Dr = np.zeros(self.M)
+        Dc = np.zeros(self.N)
+        for rows, cols, logit_P, x, pos_inds in self.block_logits(theta):
+            W = self._weights(logit_P)
+            if self.cache:
+                self.W_blocks.append(W)
+            Dr[rows] += W.sum(1)
+            if cols is None:
+                Dc += W.sum(0)
+            else:
+                Dc[cols] += W.sum(0)
+            if self.B > 0:
+                Dx += np.dot(x ** 2, W.reshape(-1))
+        return self.pack(Dx, Dr, Dc)
+
+    # P (1 - P), which is zero at the cells fixed at -inf (or at +inf,
+    # as these are compiled to -inf)
+    def _weights(self, logit_P):
+        W = inv_logit(logit_P)
+        W *= inv_logit(-logit_P)
+        return W
+
+    # Solve H delta = g for the Hessian H at theta (only for designs with
+    # row and column effects), by eliminating the row effects: their
+    # block of H is diagonal, so the Schur complement onto the rest
+    # (the covariates, kappa and the column effects) is formed directly
+    # from the cell weights, one block of rows at a time, without the
+    # design matrix. Costs O(M N (B + N)) time and O(M (B + N)) memory.
+    # Parameters marked in held are left out of the system and get a
+    # zero step.
+    def solve_newton(self, theta, g, held = None):
+        M, N, B = self.M, self.N, self.B
+        K = B + 1 + N
+        H_uv = np.zeros((M, K))
+        H_border = np.zeros((B + 1, B + 1))
+        H_bc = np.zeros((B + 1, N))
+        W_c = np.zeros(N)
+        for rows, cols, logit_P, x, pos_inds in self.block_logits(theta):
+            W = self._weights(logit_P)
+            m, n = W.shape
+            x1 = np.empty((B + 1, m * n))
+            x1[0:B] = x
+            x1[B] = 1.0
+            xW = (x1 * W.reshape(-1)).reshape((B + 1, m, n))
+            H_uv[rows,0:(B + 1)] += xW.sum(2).T
+            if cols is None:
+                cols = np.arange(N)
+                H_uv[rows,(B + 1):] += W
+            else:
+                H_uv[np.ix_(rows, (B + 1) + cols)] += W
+            H_border += np.dot(xW.reshape((B + 1, -1)), x1.T)
+            H_bc[:,cols] += xW.sum(1)
+            W_c[cols] += W.sum(0)
+
+        # Drop the last row and column effects, which are held fixed
+        D = H_uv[0:(M-1),B].copy()
+        D[D < 1e-10] = 1e-10
+        H_uv = H_uv[0:(M-1),0:(K-1)]
+        H_vv = np.zeros((K - 1, K - 1))
+        H_vv[0:(B + 1),0:(B + 1)] = H_border
+        H_vv[0:(B + 1),(B + 1):] = H_bc[:,0:(N-1)]
+        H_vv[(B + 1):,0:(B + 1)] = H_bc[:,0:(N-1)].T
+        H_vv[range(B + 1, K - 1),range(B + 1, K - 1)] = W_c[0:(N-1)]
+
+        g_u = g[(B + 1):(B + 1 + (M-1))]
+        g_v = np.concatenate([g[0:(B + 1)], g[(B + 1 + (M-1)):]])
+        if held is not None:
+            held_u = held[(B + 1):(B + 1 + (M-1))]
+            held_v = np.concatenate([held[0:(B + 1)],
+                                     held[(B + 1 + (M-1)):]])
+            H_uv[held_u] = 0.0
+            H_uv[:,held_v] = 0.0
+            D[held_u] = 1.0
+            g_u = np.where(held_u, 0.0, g_u)
+            H_vv[held_v] = 0.0
+            H_vv[:,held_v] = 0.0
+            H_vv[held_v,held_v] = 1.0
+            g_v[held_v] = 0.0
+        S = H_vv - np.dot(H_uv.T, H_uv / D.reshape((-1,1)))
+        try:
+            delta_v = solve(S, g_v - np.dot(H_uv.T, g_u / D),
+                            sym_pos = True)
+        except np.linalg.LinAlgError:
+            delta_v = np.linalg.lstsq(S, g_v - np.dot(H_uv.T, g_u / D),
+                                      rcond = None)[0]
+        delta_u = (g_u - np.dot(H_uv, delta_v)) / D
+
+        delta = np.empty_like(g)
+        delta[0:(B + 1)] = delta_v[0:(B + 1)]
+        delta[(B + 1):(B + 1 + (M-1))] = delta_u
+        delta[(B + 1 + (M-1)):] = delta_v[(B + 1):]
+        return delta
+
+    def hessian_vector(self, v):
+        M, N, B = self.M, self.N, self.B
+        v_beta = v[0:B]
+        v_a = np.zeros(M)
+        v_b = np.zeros(N)
+        if self.row_col:
+            v_a[0:(M-1)] = v[(B + 1):(B + 1 + (M-1))]
+            v_b[0:(N-1)] = v[(B + 1 + (M-1)):(B + 1 + (M-1) + (N-1))]
+        v_a += v[B]
+
+        if self.cache:
+            blocks = [(rows, cols, W, x) for (rows, cols, off, x, pos_inds), W
+                      in zip(self.blocks, self.W_blocks)]
+        else:
+            blocks = ((rows, cols, self._weights(logit_P), x)
+                      for rows, cols, logit_P, x, pos_inds
+                      in self.block_logits(self.W_theta))
+
+        Hx = np.zeros(B)
+        Hr = np.zeros(M)
+        Hc = np.zeros(N)
+        for rows, cols, W, x in blocks:
+            if B > 0:
+                u = np.dot(v_beta, x).reshape(W.shape)
+            else:
+                u = np.zeros(W.shape)
+            u += v_a[rows].reshape((-1,1))
+            if cols is None:
+                u += v_b.reshape((1,-1))
+            else:
+                u += v_b[cols].reshape((1,-1))
+            u *= W
+            Hr[rows] += u.sum(1)
+            if cols is None:
+                Hc += u.sum(0)
+            else:
+                Hc[cols] += u.sum(0)
+            if B > 0:
+                Hx += np.dot(x, u.reshape(-1))
+        return self.pack(Hx, Hr, Hc)
+
 # P_{ij} = Logit^{-1}(\sum_b x_{bij}*beta_b + kappa + o_{ij}) 
 class StationaryLogistic(Stationary):
     def __init__(self):
@@ -438,6 +1265,12 @@ class StationaryLogistic(Stationary):
         else:
             return inv_logit(logit_P)
 
+    def _predictor_terms(self, network):
+        a, b, x = Stationary._predictor_terms(self, network)
+        x = [(self.beta[b_n], network.edge_covariates[b_n])
+             for b_n in self.beta]
+        return a, b, x
+
     # The network is needed for its covariates, not for the observed
     # pattern of edges, etc.
     #
@@ -445,48 +1278,21 @@ class StationaryLogistic(Stationary):
     # useful (it gives a lower bound on the variances/covariances of
     # an unbised estimator), so that is calculated by default.
     def fisher_information(self, network, inverse = True):
-        M = network.M
-        N = network.N
-        B = len(self.beta)
-
-        P = self.edge_probabilities(network)
-
-        x = np.empty((B,M,N))
-        for i, b in enumerate(self.beta):
-            x[i] = network.edge_covariates[b].matrix()
-
-        P_bar = P * (1.0 - P)
-
-        I = np.zeros((1 + B, 1 + B))
-        I[0,0] = P_bar.sum()
-        for b in range(B):
-            v = (x[b] * P_bar).sum()
-            I[1 + b,0] = v
-            I[0,1 + b] = v
-        for b_1 in range(B):
-            for b_2 in range(B):
-                v = (x[b_1] * x[b_2] * P_bar).sum()
-                I[1 + b_1,1 + b_2] = v
-                I[1 + b_2,1 + b_1] = v
+        I = self.fisher_information_blocks(network, self.beta.keys())[0]
 
         names_theta = ['theta_{%s}' % b for b in self.beta]
-        I_names = np.array(['kappa'] + names_theta)
-        self.I = {}
-        for i in range(1 + B):
-            for j in range(1 + B):
-                if i == j:
-                    self.I[I_names[i]] = I[i,i]
-                else:
-                    self.I[(I_names[i],I_names[j])] = I[i,j]
+        I_names = ['kappa'] + names_theta
+        self.I = LabeledMatrix(I, I_names)
 
         if inverse:
             self._invert_fisher_information(I, I_names)
 
+    # The inverse is taken over the parameters with any information,
+    # and labeled by those that remain
     def _invert_fisher_information(self, I, I_names):
-        self.I_inv = {}
+        self.I_inv = LabeledMatrix(np.zeros((0,0)), [])
 
         I_r_keep = (I.sum(1) != 0)
-        L = I_r_keep.sum()
         I_keep = I[I_r_keep][:,I_r_keep]
 
         try:
@@ -495,13 +1301,8 @@ class StationaryLogistic(Stationary):
             print 'Warning: unable to invert Fisher information matrix.'
             return
 
-        I_inv_names = I_names[I_r_keep]
-        for i in range(L):
-            for j in range(L):
-                if i == j:
-                    self.I_inv[I_inv_names[i]] = I_inv[i,i]
-                else:
-                    self.I_inv[(I_inv_names[i],I_inv_names[j])] = I_inv[i,j]
+        I_inv_names = [n for n, keep in zip(I_names, I_r_keep) if keep]
+        self.I_inv = LabeledMatrix(I_inv, I_inv_names)
 
     def check_separated(self, network):
         A = network.as_dense()
@@ -529,10 +1330,17 @@ class StationaryLogistic(Stationary):
         self.fit_info['separated'] = np.any(~overlap)
 
     def baseline(self, network):
-        return np.mean(self.edge_probabilities(network))
+        total = 0.0
+        for start, stop, P in self.edge_probability_blocks(network):
+            total += P.sum()
+        return total / (network.M * network.N)
 
     def baseline_logit(self, network):
-        return np.mean(self.edge_probabilities(network, logit = True))
+        total = 0.0
+        for start, stop, logit_P in \
+          self.edge_probability_blocks(network, logit = True):
+            total += logit_P.sum()
+        return total / (network.M * network.N)
 
     def fit_convex_opt(self, network, verbose = False, fix_beta = False):
         B = len(self.beta)
@@ -545,58 +1353,45 @@ class StationaryLogistic(Stationary):
 
         # Calculate observed sufficient statistics
         T = np.empty(B + 1)
-        A = network.as_dense()
-        for b, b_n in enumerate(self.beta):
-            T[b] = (A * network.edge_covariates[b_n].matrix()).sum()
-        T[B] = A.sum(dtype=np.int)
+        Tx, r, c = self._sufficient_statistics(network)
+        T[0:B] = Tx
+        T[B] = r.sum()
 
         # Initialize theta
         theta = np.zeros(B + 1)
         if fix_beta:
             for b, b_n in enumerate(self.beta):
                 theta[b] = self.beta[b_n]
-        theta[B] = logit(A.sum(dtype=np.int) / (1.0 * network.M * network.N))
+        theta[B] = logit(T[B] / (1.0 * network.M * network.N))
         if network.offset:
-            theta[B] -= logit_mean(network.offset.matrix())
+            theta[B] -= self._offset_logit_means(network)[0]
 
-        def obj(theta):
+        design = CompiledDesign(self, network, self.beta.keys())
+
+        # Objective and gradient, from one pass over the cells
+        def obj_grad(theta):
             if np.any(np.isnan(theta)):
                 print 'Warning: computing objective for nan-containing vector.'
-                return np.Inf
-            for b, b_n in enumerate(self.beta):
-                self.beta[b_n] = theta[b]
-            self.kappa = theta[B]
-            nll = self.nll(network)
-            self.fit_info['nll_evals'] += 1
-            return nll
-        def grad(theta):
-            if np.any(np.isnan(theta)):
-                print 'Warning: computing gradient for nan-containing vector.'
-                return np.zeros(B + 1)
-            for b, b_n in enumerate(self.beta):
-                self.beta[b_n] = theta[b]
-            self.kappa = theta[B]
+                return np.Inf, np.zeros(B + 1)
             ET = np.empty(B + 1)
-            P = self.edge_probabilities(network)
-            if fix_beta:
-                ET[0:B] = 0.0
-            else:
-                for b, b_n in enumerate(self.beta):
-                    ET[b] = (P * network.edge_covariates[b_n].matrix()).sum()
-            ET[B] = P.sum()
+            nll, Ex, Er, Ec = design.evaluate(theta,
+                                              covariates = not fix_beta)
+            ET[0:B] = Ex
+            ET[B] = Er.sum()
             g = ET - T
             if fix_beta:
                 g[0:B] = 0.0
+            self.fit_info['nll_evals'] += 1
             self.fit_info['grad_nll_evals'] += 1
             self.fit_info['grad_nll_final'][:] = g
             if verbose:
                 abs_grad = np.abs(g)
                 print '|ET - T|: %.2f, %.2f, %.2f (min, mean, max)' % \
                     (np.min(abs_grad), np.mean(abs_grad), np.max(abs_grad))
-            return g
+            return nll, g
 
         bounds = [(-8,8)] * B + [(-15,15)]
-        theta_opt = opt.fmin_l_bfgs_b(obj, theta, grad, bounds = bounds)[0]
+        theta_opt = opt.fmin_l_bfgs_b(obj_grad, theta, bounds = bounds)[0]
         if (np.any(theta_opt == [b[0] for b in bounds]) or
             np.any(theta_opt == [b[1] for b in bounds])):
             print 'Warning: some constraints active in model fitting.'
@@ -626,7 +1421,7 @@ class StationaryLogistic(Stationary):
         start_time = time()
 
         A = network.as_dense()
-        r, c = A.sum(1, dtype=np.int), A.sum(0, dtype=np.int)
+        r, c = network.margins()
 
         def obj(theta):
             if np.any(np.isnan(theta)):
@@ -1005,7 +1800,7 @@ class StationaryLogistic(Stationary):
         start_time = time()
 
         A = network.as_dense()
-        r, c = A.sum(1), A.sum(0)
+        r, c = network.margins()
 
         # Initialize theta
         theta = np.zeros(B)
@@ -1093,28 +1888,24 @@ class StationaryLogistic(Stationary):
 
         self.fit_info['wall_time'] = time() - start_time
 
+    # Cells with identical covariates and offset are pooled first, which
+    # shrinks the design to a row per distinct value when the
+    # covariates are discrete (indicators, differences of classes)
     def fit_logistic(self, network):
-        import statsmodels.api as sm
-
-        M = network.M
-        N = network.N
         B = len(self.beta)
 
-        y = network.as_dense().reshape((M*N,))
-        Phi = np.zeros((M*N,B + 1))
-        Phi[:,B] = 1.0
-        for b, b_n in enumerate(self.beta):
-            Phi[:,b] =  network.edge_covariates[b_n].matrix().reshape((M*N,))
+        X, y, n, offset = pool_network_cells(network, self.beta.keys(),
+                                             bool(network.offset))
+        Phi = np.hstack([X, np.ones((X.shape[0],1))])
 
         try:
-            if network.offset:
-                offset = network.offset.matrix().reshape((M*N,))
-                fit = sm.GLM(y, Phi, sm.families.Binomial(), offset).fit()
-            else:
-                fit = sm.Logit(y, Phi).fit()
-            coefs = fit.params
+            coefs, converged = fit_binomial_logit(Phi, y, n, offset)
+            self.fit_info['converged'] = converged
+            if not converged:
+                print 'Warning: logistic fit did not converge.'
         except:
             print 'Warning: logistic fit failed.'
+            self.fit_info['converged'] = False
             coefs = np.zeros(B + 1)
 
         for b, b_n in enumerate(self.beta):
@@ -1132,19 +1923,23 @@ class StationaryLogistic(Stationary):
         
         from sklearn.linear_model import LogisticRegression
 
-        M = network.M
-        N = network.N
         B = len(self.beta)
 
-        y = network.as_dense().reshape((M*N,))
-        Phi = np.zeros((M*N,B))
-        for b, b_n in enumerate(self.beta):
-            Phi[:,b] =  network.edge_covariates[b_n].matrix().reshape((M*N,))
+        # The cells are pooled (see pool_network_cells), and each pooled
+        # row enters the fit twice, as an edge weighted by its successes
+        # and as a non-edge weighted by its failures
+        X, successes, trials, offset = pool_network_cells(network,
+                                                          self.beta.keys())
+        G = X.shape[0]
+        Phi = np.vstack([X, X])
+        y = np.concatenate([np.ones(G), np.zeros(G)])
+        weights = np.concatenate([successes, trials - successes])
+        keep = weights > 0
         lr = LogisticRegression(fit_intercept = True,
                                 C = 1.0 / prior_precision,
                                 penalty = 'l2')
         try:
-            lr.fit(Phi, y)
+            lr.fit(Phi[keep], y[keep], sample_weight = weights[keep])
             coefs, intercept = lr.coef_[0], lr.intercept_[0]
         except:
             print 'Warning: regularized logistic fit failed.'
@@ -1154,25 +1949,23 @@ class StationaryLogistic(Stationary):
             self.beta[b_n] = coefs[b]
         self.kappa = intercept
 
+        # Posterior precision is the prior precision plus the weighted
+        # Gram matrix of the pooled design (with intercept column)
         if variance_covariance:
-            S_0_inv = prior_precision * np.eye(B + 1)
-            Phi_kappa = np.hstack([Phi, np.ones((M*N,1))])
             w = np.empty(B + 1)
             w[0:B] = coefs
             w[B] = intercept
-            C = 0.0
-            for i in range(M*N):
-                y = inv_logit(np.dot(w, Phi_kappa[i,:]))
-                C += y * (1.0 - y) * (np.outer(Phi_kappa[i,:], Phi_kappa[i,:]))
-            S_N = np.linalg.inv(S_0_inv + C)
-
-            # Convert variance/covariance matrix into a dictionary
-            # indexed by pairs of parameters
-            self.variance_covariance = {}
+            Phi_kappa = np.hstack([X, np.ones((G,1))])
+            P = inv_logit(np.dot(Phi_kappa, w))
+            W_Phi = (trials * P * (1.0 - P)).reshape((-1,1)) * Phi_kappa
+            S_N_inv = prior_precision * np.eye(B + 1)
+            S_N_inv += np.dot(Phi_kappa.T, W_Phi)
+            S_N = np.linalg.inv(S_N_inv)
+
+            # Label rows and columns of the variance/covariance matrix
+            # by parameter, so entries are found as vc[(p_1,p_2)]
             parameters = self.beta.keys() + ['kappa']
-            for r, p_1 in enumerate(parameters):
-                for s, p_2 in enumerate(parameters):
-                    self.variance_covariance[(p_1,p_2)] = S_N[r,s]
+            self.variance_covariance = LabeledMatrix(S_N, parameters)
 
     def confidence_wald(self, network, alpha_level = 0.05, **fit_options):
         self.fit(network, **fit_options)
@@ -1200,7 +1993,8 @@ class StationaryLogistic(Stationary):
         theta_hats['_kappa'] = self.kappa
 
         # Parametric bootstrap to characterize uncertainty in point estimate
-        network_samples = [self.generate(network) for k in range(n_bootstrap)]
+        network_samples = [PackedMatrix.from_dense(self.generate(network))
+                           for k in range(n_bootstrap)]
         network_original = network.array.copy()
         theta_hat_bootstraps = { b: np.empty(n_bootstrap) for b in self.beta }
         theta_hat_bootstraps['_kappa'] = np.empty(n_bootstrap)
@@ -1245,21 +2039,29 @@ class StationaryLogistic(Stationary):
         x = network.edge_covariates[b].matrix()
 
         # Row and column margins; the part of the data we can use to design Q
-        r, c = A.sum(1), A.sum(0)
+        r, c = network.margins()
+
+        # The weights exp(theta * x) are identified to the caches in
+        # BinaryMatrix by theta and a digest of x taken once here
+        x_hash = digest(np.ascontiguousarray(x))
 
         # Evaluate log-likelihood at specified parameter value
         def log_likelihood(z, theta):
-            return -acnll(z, np.exp(theta * x), sort_by_wopt_var = False)
+            if isinstance(z, PackedMatrix):
+                z = z.toarray()
+            return -acnll(z, np.exp(theta * x), sort_by_wopt_var = False,
+                          w_key = (x_hash, theta))
 
-        # Generate sample from k-th component of mixture proposal distribution
+        # Generate sample from k-th component of mixture proposal
+        # distribution, kept bit-packed since n_MC of them are held
         def sample(theta):
             Y_sparse = acsample(r, c, np.exp(theta * x), T = 0,
-                                sort_by_wopt_var = False)
-            Y_dense = np.zeros((M,N), dtype = np.bool)
-            for i, j in Y_sparse:
-                if i == -1: break
-                Y_dense[i,j] = 1
-            return Y_dense
+                                sort_by_wopt_var = False,
+                                w_key = (x_hash, theta))
+            Y_sparse = np.array(Y_sparse, dtype = np.int).reshape((-1,2))
+            n_edges = np.sum(np.cumprod(Y_sparse[:,0] != -1))
+            return PackedMatrix.from_cells(M, N, Y_sparse[:n_edges,0],
+                                           Y_sparse[:n_edges,1])
 
         theta_grid = np.linspace(beta_l_min, beta_l_max, L)
 
@@ -1268,7 +2070,11 @@ class StationaryLogistic(Stationary):
             name = 'conservative-score'
             two_sided = True
             def t(z):
-                return np.array([(z * x).sum() for theta_l in theta_grid])
+                if isinstance(z, PackedMatrix):
+                    z_x = z.masked_sum(x)
+                else:
+                    z_x = (z * x).sum()
+                return np.repeat(z_x, len(theta_grid))
         elif test == 'lr':
             name = 'conservative-lr'
             two_sided = False
@@ -1325,6 +2131,12 @@ class NonstationaryLogistic(StationaryLogistic):
         else:
             return inv_logit(logit_P)
 
+    def _predictor_terms(self, network):
+        a, b, x = StationaryLogistic._predictor_terms(self, network)
+        a = a + network.row_covariates['alpha_out'][:]
+        b = b + network.col_covariates['alpha_in'][:]
+        return a, b, x
+
     def baseline(self, network):
         M = network.M
         N = network.N
@@ -1376,94 +2188,37 @@ class NonstationaryLogistic(StationaryLogistic):
 
         start_time = time()
 
-        if network.offset:
-            O = network.offset.matrix()
-        alpha_zero(network)
+        T, theta = self._initial_theta(network, fix_beta)
 
-        # Calculate observed sufficient statistics
-        T = np.empty(B + 1 + (M-1) + (N-1))
-        A = network.as_dense()
-        r = A.sum(1, dtype=np.int)[0:(M-1)]
-        c = A.sum(0, dtype=np.int)[0:(N-1)]
-        A_sum = A.sum(dtype=np.int)
-        for b, b_n in enumerate(self.beta):
-            T[b] = (A * network.edge_covariates[b_n].matrix()).sum()
-        T[B] = A_sum
-        T[(B + 1):(B + 1 + (M-1))] = r
-        T[(B + 1 + (M-1)):(B + 1 + (M-1) + (N-1))] = c
-
-        # Initialize theta
-        theta = np.zeros(B + 1 + (M-1) + (N-1))
-        if fix_beta:
-            for b, b_n in enumerate(self.beta):
-                theta[b] = self.beta[b_n]
-        theta[B] = logit((A_sum + 1.0) / (1.0 * M * N + 2.0))
-        if network.offset:
-            theta[B] -= logit_mean(O)
-        theta[(B + 1):(B + 1 + (M-1) + (N-1))] = -theta[B]
-        for i in range(M-1):
-            theta[B + 1 + i] += \
-              logit((r[i] + 1.0) / (N + 2.0))
-            if network.offset:
-                o_row = logit_mean(O[i,:])
-                if np.isfinite(o_row):
-                    theta[B + 1 + i] -= o_row
-        for j in range(N-1):
-            theta[B + 1 + (M-1) + j] += \
-              logit((c[j] + 1.0) / (M + 2.0))
-            if network.offset:
-                o_col = logit_mean(O[:,j])
-                if np.isfinite(o_col):
-                    theta[B + 1 + (M-1) + j] -= o_col
+        design = CompiledDesign(self, network, self.beta.keys(),
+                                row_col = True)
 
-        alpha_out = network.row_covariates['alpha_out']
-        alpha_in = network.col_covariates['alpha_in']
-        def obj(theta):
+        # Objective and gradient, from one pass over the cells
+        def obj_grad(theta):
             if np.any(np.isnan(theta)):
                 print 'Warning: computing objective for nan-containing vector.'
-                return np.Inf
-            alpha_out[0:M-1] = theta[(B + 1):(B + 1 + (M-1))]
-            alpha_in[0:N-1] = theta[(B + 1 + (M-1)):(B + 1 + (M-1) + (N-1))]
-            for b, b_n in enumerate(self.beta):
-                self.beta[b_n] = theta[b]
-            self.kappa = theta[B]
-            nll = self.nll(network)
-            self.fit_info['nll_evals'] += 1
-            return nll
-        def grad(theta):
-            if np.any(np.isnan(theta)):
-                print 'Warning: computing gradient for nan-containing vector.'
-                return np.zeros(B + 1 + (M-1) + (N-1))
-            alpha_out[0:M-1] = theta[(B + 1):(B + 1 + (M-1))]
-            alpha_in[0:N-1] = theta[(B + 1 + (M-1)):(B + 1 + (M-1) + (N-1))]
-            for b, b_n in enumerate(self.beta):
-                self.beta[b_n] = theta[b]
-            self.kappa = theta[B]
+                return np.Inf, np.zeros(B + 1 + (M-1) + (N-1))
             ET = np.empty(B + 1 + (M-1) + (N-1))
-            P = self.edge_probabilities(network)
-            Er = P.sum(1)[0:(M-1)]
-            Ec = P.sum(0)[0:(N-1)]
-            ET[(B + 1):(B + 1 + (M-1))] = Er
-            ET[(B + 1 + (M-1)):(B + 1 + (M-1) + (N-1))] = Ec
-            if fix_beta:
-                ET[0:B] = 0.0
-            else:
-                for b, b_n in enumerate(self.beta):
-                    ET[b] = (P * network.edge_covariates[b_n].matrix()).sum()
-            ET[B] = P.sum()
+            nll, Ex, Er, Ec = design.evaluate(theta,
+                                              covariates = not fix_beta)
+            ET[(B + 1):(B + 1 + (M-1))] = Er[0:(M-1)]
+            ET[(B + 1 + (M-1)):(B + 1 + (M-1) + (N-1))] = Ec[0:(N-1)]
+            ET[0:B] = Ex
+            ET[B] = Er.sum()
             g = ET - T
             if fix_beta:
                 g[0:B] = 0.0
+            self.fit_info['nll_evals'] += 1
             self.fit_info['grad_nll_evals'] += 1
             self.fit_info['grad_nll_final'][:] = g
             if verbose:
                 abs_grad = np.abs(g)
                 print '|ET - T|: %.2f, %.2f, %.2f (min, mean, max)' % \
                     (np.min(abs_grad), np.mean(abs_grad), np.max(abs_grad))
-            return g
+            return nll, g
 
         bounds = [(-8,8)] * B + [(-15,15)] + [(-8,8)] * ((M-1) + (N-1))
-        theta_opt = opt.fmin_l_bfgs_b(obj, theta, grad, bounds = bounds)[0]
+        theta_opt = opt.fmin_l_bfgs_b(obj_grad, theta, bounds = bounds)[0]
         if (np.any(theta_opt == [b[0] for b in bounds]) or
             np.any(theta_opt == [b[1] for b in bounds])):
             print 'Warning: some constraints active in model fitting.'
@@ -1484,17 +2239,161 @@ class NonstationaryLogistic(StationaryLogistic):
                         print 'beta_%d: %.2f (T = %.2f)' % \
                             (j, theta_opt[c_j], T[c_j])
 
-        alpha_out[0:M-1] = theta_opt[(B + 1):(B + 1 + (M-1))]
-        alpha_in[0:N-1] = theta_opt[(B + 1 + (M-1)):(B + 1 + (M-1) + (N-1))]
+        self._set_theta(network, theta_opt)
+
+        self.fit_info['wall_time'] = time() - start_time
+
+    # Truncated Newton fitting of the same problem as fit_convex_opt.
+    # The Hessian has diagonal row and column blocks, a dense row x
+    # column coupling (the cell weights P (1 - P)) and a small border
+    # for kappa and the covariates; each Newton step is solved by
+    # conjugate gradients with Hessian-vector products (one pass over
+    # the cells each) and the Hessian diagonal as preconditioner, then
+    # damped by a backtracking line search. Parameters are kept within
+    # the same bounds as in fit_convex_opt.
+    def fit_newton(self, network, verbose = False, fix_beta = False,
+                   tol = 1e-6, max_iter = 50, max_cg_iter = 50):
+        M = network.M
+        N = network.N
+        B = len(self.beta)
+
+        self.fit_info['nll_evals'] = 0
+        self.fit_info['grad_nll_evals'] = 0
+        self.fit_info['newton_iters'] = 0
+        self.fit_info['cg_iters'] = 0
+
+        start_time = time()
+
+        T, theta = self._initial_theta(network, fix_beta)
+        design = CompiledDesign(self, network, self.beta.keys(),
+                                row_col = True)
+        lower = np.array([-8.0] * B + [-15.0] + [-8.0] * ((M-1) + (N-1)))
+        upper = -lower
+        free = np.ones(len(theta), dtype = np.bool)
+        if fix_beta:
+            free[0:B] = False
+
+        def obj_grad(theta):
+            nll, Ex, Er, Ec = design.evaluate(theta,
+                                              covariates = not fix_beta)
+            g = design.pack(Ex, Er, Ec) - T
+            g[~free] = 0.0
+            self.fit_info['nll_evals'] += 1
+            self.fit_info['grad_nll_evals'] += 1
+            return nll, g
+
+        nll, g = obj_grad(theta)
+        for it in range(max_iter):
+            # Parameters held at a bound by the gradient are left out
+            # of the step (and of the convergence test)
+            held = (((theta <= lower) & (g > 0)) |
+                    ((theta >= upper) & (g < 0)))
+            step_free = free & ~held
+            g_step = g * step_free
+            g_norm = l2(g_step)
+            if verbose:
+                print 'Newton %d: nll = %.4f, |g| = %.2e' % (it, nll, g_norm)
+            if np.abs(g_step).max() < tol:
+                break
+
+            d = design.set_curvature(theta)
+            d[~step_free] = 1.0
+            d[d < 1e-10] = 1e-10
+            def H_dot(v):
+                v = v * step_free
+                return design.hessian_vector(v) * step_free
+            step, cg_iters = pcg(H_dot, -g_step, d,
+                                 min(0.5, np.sqrt(g_norm)) * g_norm,
+                                 max_cg_iter)
+            self.fit_info['cg_iters'] += cg_iters
+
+            # Backtracking line search on the bounded parameters
+            t = 1.0
+            for ls in range(30):
+                theta_new = np.clip(theta + t * step, lower, upper)
+                nll_new, g_new = obj_grad(theta_new)
+                if nll_new <= nll + 1e-4 * np.dot(g_step, theta_new - theta):
+                    break
+                t /= 2.0
+            else:
+                break
+            theta, nll, g = theta_new, nll_new, g_new
+        self.fit_info['newton_iters'] = it + 1
+        self.fit_info['grad_nll_final'] = g
+
+        if np.any(theta == lower) or np.any(theta == upper):
+            print 'Warning: some constraints active in model fitting.'
+
+        self._set_theta(network, theta)
+
+        self.fit_info['wall_time'] = time() - start_time
+
+    # Observed sufficient statistics and starting parameters for the
+    # direct fitting methods, in their layout (see CompiledDesign). The
+    # row and column effects are reset to zero.
+    def _initial_theta(self, network, fix_beta):
+        M = network.M
+        N = network.N
+        B = len(self.beta)
+
+        if network.offset:
+            o_mean, o_rows, o_cols = self._offset_logit_means(network)
+        alpha_zero(network)
+
+        # Calculate observed sufficient statistics
+        T = np.empty(B + 1 + (M-1) + (N-1))
+        Tx, r, c = self._sufficient_statistics(network)
+        A_sum = r.sum()
+        r = r[0:(M-1)]
+        c = c[0:(N-1)]
+        T[0:B] = Tx
+        T[B] = A_sum
+        T[(B + 1):(B + 1 + (M-1))] = r
+        T[(B + 1 + (M-1)):(B + 1 + (M-1) + (N-1))] = c
+
+        # Initialize theta
+        theta = np.zeros(B + 1 + (M-1) + (N-1))
+        if fix_beta:
+            for b, b_n in enumerate(self.beta):
+                theta[b] = self.beta[b_n]
+        theta[B] = logit((A_sum + 1.0) / (1.0 * M * N + 2.0))
+        if network.offset:
+            theta[B] -= o_mean
+        theta[(B + 1):(B + 1 + (M-1) + (N-1))] = -theta[B]
+        for i in range(M-1):
+            theta[B + 1 + i] += \
+              logit((r[i] + 1.0) / (N + 2.0))
+            if network.offset:
+                o_row = o_rows[i]
+                if np.isfinite(o_row):
+                    theta[B + 1 + i] -= o_row
+        for j in range(N-1):
+            theta[B + 1 + (M-1) + j] += \
+              logit((c[j] + 1.0) / (M + 2.0))
+            if network.offset:
+                o_col = o_cols[j]
+                if np.isfinite(o_col):
+                    theta[B + 1 + (M-1) + j] -= o_col
+
+        return T, theta
+
+    # Set the parameters from theta, centering the row and column effects
+    def _set_theta(self, network, theta):
+        M = network.M
+        N = network.N
+        B = len(self.beta)
+
+        alpha_out = network.row_covariates['alpha_out']
+        alpha_in = network.col_covariates['alpha_in']
+        alpha_out[0:M-1] = theta[(B + 1):(B + 1 + (M-1))]
+        alpha_in[0:N-1] = theta[(B + 1 + (M-1)):(B + 1 + (M-1) + (N-1))]
         alpha_out_mean = np.mean(alpha_out[:])
         alpha_in_mean = np.mean(alpha_in[:])
         alpha_out[:] -= alpha_out_mean
         alpha_in[:] -= alpha_in_mean
         for b, b_n in enumerate(self.beta):
-            self.beta[b_n] = theta_opt[b]
-        self.kappa = theta_opt[B] + alpha_out_mean + alpha_in_mean
-
-        self.fit_info['wall_time'] = time() - start_time
+            self.beta[b_n] = theta[b]
+        self.kappa = theta[B] + alpha_out_mean + alpha_in_mean
 
     def fit_conditional(self, network, **kwargs):
         StationaryLogistic.fit_conditional(self, network, **kwargs)
@@ -1505,7 +2404,21 @@ class NonstationaryLogistic(StationaryLogistic):
 
         self.fit_info['wall_time'] += time() - start_time
 
-    def fit_irls(self, network, verbose = False, perturb = 1e-4):
+    # Iteratively reweighted least squares. By default, the normal
+    # equations are solved from their structure (see
+    # CompiledDesign.solve_newton), never forming the design matrix;
+    # steps are halved until the nll does not increase and kept within
+    # the bounds of fit_convex_opt, and iteration stops once the
+    # largest update to the parameters is below tol (recorded in
+    # fit_info['converged']). With dense_design = True, the (M*N) x P
+    # design matrix is formed and solved against directly, with the
+    # uniform perturbation keeping the system well-conditioned.
+    def fit_irls(self, network, verbose = False, perturb = 1e-4,
+                 dense_design = False, tol = 1e-6, max_iter = 10):
+        if not dense_design:
+            return self._fit_irls_structured(network, verbose, tol,
+                                             max_iter)
+
         M = network.M
         N = network.N
         B = len(self.beta)
@@ -1544,7 +2457,7 @@ class NonstationaryLogistic(StationaryLogistic):
             self.kappa = theta_vec[B]
             return self.edge_probabilities(network).reshape((M*N,1))
 
-        for iter in range(10):
+        for iter in range(max_iter):
             p = fitted_p(theta)
             X_tilde = X * p
             del p
@@ -1555,7 +2468,11 @@ class NonstationaryLogistic(StationaryLogistic):
             del X_tilde
             hat = solve(X_t_X_tilde, X_t, overwrite_a = True)
             p = fitted_p(theta)
-            theta += np.dot(hat, (y - p))
+            delta = np.dot(hat, (y - p))
+            theta += delta
+            if np.abs(delta).max() < tol:
+                break
+        self.fit_info['converged'] = np.abs(delta).max() < tol
 
         theta_vec = np.reshape(theta, (P,))
         alpha_out[0:M-1] = theta_vec[(B + 1):(B + 1 + (M-1))]
@@ -1569,39 +2486,93 @@ class NonstationaryLogistic(StationaryLogistic):
         self.kappa = theta_vec[B] + alpha_out_mean + alpha_in_mean
 
         self.fit_info['wall_time'] = time() - start_time
-        
-    def fit_logistic(self, network):
-        import statsmodels.api as sm
+
+    def _fit_irls_structured(self, network, verbose, tol, max_iter):
+        start_time = time()
 
         M = network.M
         N = network.N
         B = len(self.beta)
 
-        # Set up outcome and design matrix for fit
-        y = network.as_dense().reshape((M*N,))
-        Phi = np.zeros((M*N,B + 1 + (M-1) + (N-1)))
-        for b, b_n in enumerate(self.beta):
-            Phi[:,b] =  network.edge_covariates[b_n].matrix().reshape((M*N,))
-        Phi[:,B] = 1.0
-        for r in range(M-1):
-            phi_row = np.zeros((M,N))
-            phi_row[r,:] = 1.0
-            Phi[:,B + 1 + r] = phi_row.reshape((M*N,))
-        for c in range(N-1):
-            phi_col = np.zeros((M,N))
-            phi_col[:,c] = 1.0
-            Phi[:,B + 1 + (M-1) + c] = phi_col.reshape((M*N,))
+        T, theta = self._initial_theta(network, False)
+        design = CompiledDesign(self, network, self.beta.keys(),
+                                row_col = True)
+        lower = np.array([-8.0] * B + [-15.0] + [-8.0] * ((M-1) + (N-1)))
+        upper = -lower
+        theta = np.clip(theta, lower, upper)
+        self.fit_info['irls_iters'] = 0
+        self.fit_info['converged'] = False
+
+        nll, Ex, Er, Ec = design.evaluate(theta)
+        for iter in range(max_iter):
+            # Parameters held at a bound by the gradient are left out
+            # of the step
+            g = T - design.pack(Ex, Er, Ec)
+            held = (((theta <= lower) & (g < 0)) |
+                    ((theta >= upper) & (g > 0)))
+            delta = design.solve_newton(theta, g, held)
+
+            # Step halving on the nll, keeping the parameters within the
+            # same bounds as in fit_convex_opt; a row or column with no
+            # (or all) edges otherwise sends its effect off to infinity
+            t = 1.0
+            for ls in range(30):
+                theta_new = np.clip(theta + t * delta, lower, upper)
+                nll_new, Ex, Er, Ec = design.evaluate(theta_new)
+                if nll_new <= nll + 1e-10 * (abs(nll) + 1.0):
+                    break
+                t /= 2.0
+            else:
+                break
+            step = theta_new - theta
+            theta, nll = theta_new, nll_new
+            self.fit_info['irls_iters'] += 1
+            if verbose:
+                print 'IRLS %d: nll = %.4f, max |step| = %.2e' % \
+                  (iter, nll, np.abs(step).max())
+            if np.abs(step).max() < tol:
+                self.fit_info['converged'] = True
+                break
+
+        if not self.fit_info['converged']:
+            print 'Warning: IRLS did not converge.'
+        if np.any(theta == lower) or np.any(theta == upper):
+            print 'Warning: some constraints active in model fitting.'
+
+        self._set_theta(network, theta)
+
+        self.fit_info['wall_time'] = time() - start_time
+
+    # The row and column indicators make every cell distinct, so
+    # instead of pooling, the design is built as a sparse matrix with
+    # B + 3 entries per cell (see network_design), rather than densely
+    # with B + M + N - 1. The coefficients are kept within the same
+    # bounds as in fit_convex_opt, so that rows and columns separated
+    # by the data end up where the other fitting methods put them.
+    def fit_logistic(self, network):
+        M = network.M
+        N = network.N
+        B = len(self.beta)
+
+        Phi, y, offset = network_design(network, self.beta.keys(),
+                                        bool(network.offset))
+        n = np.ones(len(y))
+        lower = np.array([-8.0] * B + [-15.0] + [-8.0] * ((M-1) + (N-1)))
+        upper = -lower
 
         # Do fit, defaulting to beta = 0 in case of problems
         try:
-            if network.offset:
-                offset = network.offset.matrix().reshape((M*N,))
-                fit = sm.GLM(y, Phi, sm.families.Binomial(), offset).fit()
-            else:
-                fit = sm.Logit(y, Phi).fit()
-            coefs = fit.params
+            coefs, converged = fit_binomial_logit(Phi, y, n, offset,
+                                                  lower = lower,
+                                                  upper = upper)
+            self.fit_info['converged'] = converged
+            if not converged:
+                print 'Warning: logistic fit did not converge.'
+            if np.any(coefs == lower) or np.any(coefs == upper):
+                print 'Warning: some constraints active in model fitting.'
         except:
             print 'Warning: logistic fit failed.'
+            self.fit_info['converged'] = False
             coefs = np.zeros(B + 1 + (M-1) + (N-1))
 
         alpha_zero(network)
@@ -1629,59 +2600,40 @@ class NonstationaryLogistic(StationaryLogistic):
         B = len(self.beta)
 
         P = self.edge_probabilities(network)
-
-        x = np.empty((B,M,N))
-        for i, b in enumerate(self.beta):
-            x[i] = network.edge_covariates[b].matrix()
-
         P_bar = P * (1.0 - P)
 
-        I = np.zeros(((M-1) + (N-1) + 1 + B, (M-1) + (N-1) + 1 + B))
-        for i in range(M-1):
-            for j in range(N-1):
-                v = P_bar[i,j]
-                I[i,(M-1)+j] = v
-                I[(M-1)+j,i] = v
-        for i in range(M-1):
-            v = (P_bar[i,:]).sum()
-            I[i,i] = v
-            I[(M-1) + (N-1),i] = v
-            I[i,(M-1) + (N-1)] = v
-            for b in range(B):
-                v = (x[b,i,:] * P_bar[i,:]).sum()
-                I[(M-1) + (N-1) + 1 + b,i] = v
-                I[i,(M-1) + (N-1) + 1 + b] = v
-        for j in range(N-1):
-            v = (P_bar[:,j]).sum()
-            I[(M-1) + j,(M-1) + j] = v
-            I[(M-1) + (N-1),(M-1) + j] = v
-            I[(M-1) + j,(M-1) + (N-1)] = v
-            for b in range(B):
-                v = (x[b,:,j] * P_bar[:,j]).sum()
-                I[(M-1) + (N-1) + 1 + b,(M-1) + j] = v
-                I[(M-1) + j,(M-1) + (N-1) + 1 + b] = v
-        I[(M-1) + (N-1),(M-1) + (N-1)] = P_bar.sum()
-        for b in range(B):
-            v = (x[b] * P_bar).sum()
-            I[(M-1) + (N-1) + 1 + b,(M-1) + (N-1)] = v
-            I[(M-1) + (N-1),(M-1) + (N-1) + 1 + b] = v
-        for b_1 in range(B):
-            for b_2 in range(B):
-                v = (x[b_1] * x[b_2] * P_bar).sum()
-                I[(M-1) + (N-1) + 1 + b_1,(M-1) + (N-1) + 1 + b_2] = v
-                I[(M-1) + (N-1) + 1 + b_2,(M-1) + (N-1) + 1 + b_1] = v
+        # Stack of the covariates shared by all cells, the intercept
+        # (for kappa) and the edge covariates (for theta)
+        u = np.empty((1 + B,M,N))
+        u[0] = 1.0
+        for b, b_n in enumerate(self.beta):
+            u[1 + b] = network.edge_covariates[b_n].matrix()
+
+        # Parameters are laid out as alpha_{0:M-1}, beta_{0:N-1},
+        # kappa, theta_{1:B}
+        L = (M-1) + (N-1) + 1 + B
+        r = slice(0, M-1)
+        c = slice(M-1, (M-1) + (N-1))
+        k = slice((M-1) + (N-1), L)
+        u_r = np.einsum('kij,ij->ki', u, P_bar)[:,0:(M-1)]
+        u_c = np.einsum('kij,ij->kj', u, P_bar)[:,0:(N-1)]
+        u_flat = u.reshape((1 + B,M*N))
+        I = np.zeros((L,L))
+        I[r,r] = np.diag(u_r[0])
+        I[c,c] = np.diag(u_c[0])
+        I[r,c] = P_bar[0:(M-1),0:(N-1)]
+        I[c,r] = I[r,c].T
+        I[k,r] = u_r
+        I[r,k] = u_r.T
+        I[k,c] = u_c
+        I[c,k] = u_c.T
+        I[k,k] = np.dot(u_flat * P_bar.reshape(-1), u_flat.T)
 
         names_alpha = ['alpha_{%s}' % n for n in network.rnames[0:(M-1)]]
         names_beta = ['beta_{%s}' % n for n in network.cnames[0:(N-1)]]
         names_theta = ['theta_{%s}' % b for b in self.beta]
-        I_names = np.array(names_alpha + names_beta + ['kappa'] + names_theta)
-        self.I = {}
-        for i in range((M-1) + (N-1) + 1 + B):
-            for j in range((M-1) + (N-1) + 1 + B):
-                if i == j:
-                    self.I[I_names[i]] = I[i,i]
-                else:
-                    self.I[(I_names[i],I_names[j])] = I[i,j]
+        I_names = names_alpha + names_beta + ['kappa'] + names_theta
+        self.I = LabeledMatrix(I, I_names)
 
         if inverse:
             self._invert_fisher_information(I, I_names)
@@ -1698,12 +2650,43 @@ class Blockmodel(IndependentBernoulli):
         self.fit = self.fit_sem
         self.ignore_inner_offset = ignore_inner_offset
         
-    def apply_to_offset(self, network):
-        N = network.N
+    # Block effects Theta[z_i, z_j], looked up for all cells at once
+    # (or for the submatrix given as (row indices, column indices))
+    def block_effects(self, network, submatrix = None):
+        z = network.node_covariates[self.block_name][:]
+        if submatrix:
+            i_sub, j_sub = submatrix
+            return self.Theta[z[i_sub].reshape((-1,1)),
+                              z[j_sub].reshape((1,-1))]
+        return self.Theta[z.reshape((-1,1)), z.reshape((1,-1))]
+
+    def _logit_rows(self, network, ignore_offset):
+        if ignore_offset is None:
+            ignore_offset = self.ignore_inner_offset
+        base_rows = self.base_model._logit_rows(network, ignore_offset)
+        if ignore_offset:
+            return base_rows
+
+        z = network.node_covariates[self.block_name][:]
+        Theta = self.Theta
+        def logit_rows(start, stop):
+            logit_P = base_rows(start, stop)
+            logit_P += Theta[z[start:stop].reshape((-1,1)),
+                             z.reshape((1,-1))]
+            return logit_P
+        return logit_rows
+
+    # Offset with the block effects added to the existing one, which
+    # is left as it is; see BlockEffectOffset
+    def block_offset(self, network):
         z = network.node_covariates[self.block_name]
-        for i in range(N):
-            for j in range(N):
-                network.offset[i,j] += self.Theta[z[i], z[j]]
+        return BlockEffectOffset(network.rnames, network.cnames, z, z,
+                                 self.Theta, network.offset)
+
+    # Add the block effects to the offset of the network, by wrapping
+    # the existing offset rather than writing out a dense matrix
+    def apply_to_offset(self, network):
+        network.offset = self.block_offset(network)
 
     def edge_probabilities(self, network, submatrix = None,
                            ignore_offset = None, logit = False):
@@ -1712,20 +2695,19 @@ class Blockmodel(IndependentBernoulli):
         else:
             ignore_inner_offset = ignore_offset
 
-        if network.offset is None:
-            network.initialize_offset()
-        old_offset = network.offset.copy()
-        self.apply_to_offset(network)
-
-        # If outer ignore_offset, then the inner offset is just block
-        # effects, and so should be used. If not outer ignore_offset,
-        # then the offset should be used anyways.
-        P = self.base_model.edge_probabilities(network, submatrix, \
-              ignore_offset = ignore_inner_offset, logit = logit)
+        # The block effects enter the base model as part of its offset,
+        # so are ignored along with it; otherwise, as the base model
+        # is linear in the offset on the logit scale, they're just
+        # added to its logits.
+        logit_P = self.base_model.edge_probabilities(network, submatrix, \
+              ignore_offset = ignore_inner_offset, logit = True)
+        if not ignore_inner_offset:
+            logit_P = logit_P + self.block_effects(network, submatrix)
 
-        network.offset = old_offset
-
-        return P
+        if logit:
+            return logit_P
+        else:
+            return inv_logit(logit_P)
 
     def baseline(self, network):
         return self.base_model.baseline(network)
@@ -1734,19 +2716,12 @@ class Blockmodel(IndependentBernoulli):
         return self.base_model.baseline_logit(network)
 
     def match_kappa(self, network, kappa_target):
-        if network.offset:
-            old_offset = network.offset.copy()
-        else:
-            network.initialize_offset()
-            old_offset = None
-        self.apply_to_offset(network)
-
-        self.base_model.match_kappa(network, kappa_target)
-
-        if old_offset:
+        old_offset = network.offset
+        network.offset = self.block_offset(network)
+        try:
+            self.base_model.match_kappa(network, kappa_target)
+        finally:
             network.offset = old_offset
-        else:
-            network.offset = None
 
     # Stochastic EM fitting with `sweeps` Gibbs sweeps in the E-step
     # and `cycles` repetitions of the entire E-step/M-step operation
@@ -1771,9 +2746,9 @@ class Blockmodel(IndependentBernoulli):
                     cov_name = '_%d_%d' % (s,t)
                     cov_name_to_inds[cov_name] = (s,t)
                     cov = network.new_edge_covariate(cov_name)
-                    def f_edge_class(i_1, i_2):
-                        return (z[i_1] == s) and (z[i_2] == t)
-                    cov.from_binary_function_ind(f_edge_class)
+                    def f_edge_class(z_1, z_2):
+                        return (z_1 == s) & (z_2 == t)
+                    cov.from_node_covariates(z, z, f_edge_class)
                     self.base_model.beta[cov_name] = None
                     
             self.base_model.fit(network, **base_fit_options)
@@ -1833,10 +2808,19 @@ class Blockmodel(IndependentBernoulli):
         z = network.node_covariates[self.block_name]
         A = network.as_dense()
 
+        # Fits are cached by the labeling z, keyed by a hash that is
+        # updated in O(1) as single nodes are relabeled (Zobrist
+        # hashing) rather than by rehashing all of z for each fit
+        z_codes = np.random.RandomState(0).randint(0, 2**62, (N, K))
+        def z_code(z):
+            inds = z[:].astype(np.int)
+            return np.bitwise_xor.reduce(z_codes[np.arange(N), inds])
+        def z_code_move(code, m, z_from, z_to):
+            return code ^ z_codes[m, z_from] ^ z_codes[m, z_to]
+
         z_to_nll_cache = {}
         cov_name_to_inds = {}
-        def fit_at_z(z):
-            z_hash = digest(z[:])
+        def fit_at_z(z, z_hash):
             if z_hash in z_to_nll_cache:
                 return z_to_nll_cache[z_hash]
             
@@ -1846,9 +2830,9 @@ class Blockmodel(IndependentBernoulli):
                     cov_name = '_%d_%d' % (s,t)
                     cov_name_to_inds[cov_name] = (s,t)
                     cov = network.new_edge_covariate(cov_name)
-                    def f_edge_class(i_1, i_2):
-                        return (z[i_1] == s) and (z[i_2] == t)
-                    cov.from_binary_function_ind(f_edge_class)
+                    def f_edge_class(z_1, z_2):
+                        return (z_1 == s) & (z_2 == t)
+                    cov.from_node_covariates(z, z, f_edge_class)
                     self.base_model.beta[cov_name] = None
                     
             self.base_model.fit(network, **base_fit_options)
@@ -1861,6 +2845,7 @@ class Blockmodel(IndependentBernoulli):
             z_states = []
             unmoved = range(N)
             np.random.shuffle(unmoved)
+            z_hash = z_code(z)
             while len(unmoved) > 0:
                 # Defaults may actually be used when NLL calculation
                 # behaves poorly...
@@ -1871,10 +2856,12 @@ class Blockmodel(IndependentBernoulli):
                         if z_m == z_m_current:
                             continue
                         z[m] = z_m
-                        nll = fit_at_z(z)
+                        nll = fit_at_z(z, z_code_move(z_hash, m,
+                                                      z_m_current, z_m))
                         if nll < best_nll:
                             best_nll, best_m, best_z_m = nll, m, z_m
                     z[m] = z_m_current
+                z_hash = z_code_move(z_hash, best_m, z[best_m], best_z_m)
                 z[best_m] = best_z_m
                 unmoved.remove(best_m)
                 z_states.append((best_nll, z[:].copy()))
@@ -1940,13 +2927,13 @@ class FixedMargins(IndependentBernoulli):
 
         if not self.r_name in network.row_covariates:
             print 'Row covariate "%s" not found.' % self.r_name
-            r = np.asarray(network.as_dense()).sum(1, dtype = np.int)
+            r = network.margins()[0]
         else:
             r = network.row_covariates[self.r_name][:]
 
         if not self.c_name in network.col_covariates:
             print 'Column covariate "%s" not found.' % self.c_name
-            c = np.asarray(network.as_dense()).sum(0, dtype = np.int)
+            c = network.margins()[1]
         else:
             c = network.col_covariates[self.c_name][:]
 
@@ -1961,6 +2948,9 @@ class FixedMargins(IndependentBernoulli):
     def edge_probabilities(self, network, **opts):
         return self.base_model.edge_probabilities(network, **opts)
 
+    def _logit_rows(self, network, ignore_offset):
+        return self.base_model._logit_rows(network, ignore_offset)
+
     def confidence_wald(self, network, alpha_level = 0.05, **fit_options):
         self.fit(network, **fit_options)
 
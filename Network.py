@@ -4,30 +4,47 @@
 # Daniel Klein, 5/10/2012
 
 from os import system, unlink
+from itertools import islice
 import numpy as np
 import scipy.sparse as sparse
 import networkx as nx
 import matplotlib.pyplot as plt
 
 from Array import Array
-from Covariate import NodeCovariate
+from Covariate import NodeCovariate, NameIndex
+from Storage import load_archive
 
 class Network(Array):
-    def __init__(self, N = 0, names = None):
-        Array.__init__(self, N, N)
+    def __init__(self, N = 0, names = None, storage = 'csr', scratch = None):
+        Array.__init__(self, N, N, storage, scratch)
         if names is None:
             self.names = np.array(['%d' % n for n in range(self.N)])
         else:
             self.names = names
-        self.rnames = self.names
-        self.cnames = self.names
         self.node_covariates = {}
 
+    # Renaming nodes (by assigning to names) replaces the name index
+    @property
+    def names(self):
+        return self._names
+
+    @names.setter
+    def names(self, names):
+        self._names = names
+        self.rnames = names
+        self.cnames = names
+        self.name_index = NameIndex(names)
+
+    # Indices of the nodes with the given names (-1 for unknown names)
+    def find(self, names):
+        return self.name_index.find(names)
+
     def new_node_covariate(self, name, as_int = False):
         if as_int:
-            node_cov = NodeCovariate(self.names, dtype = np.int)
+            dtype = np.int
         else:
-            node_cov = NodeCovariate(self.names)
+            dtype = np.float
+        node_cov = NodeCovariate(self.names, dtype, self.name_index)
         self.node_covariates[name] = node_cov
         self.row_covariates[name] = node_cov
         self.col_covariates[name] = node_cov
@@ -36,11 +53,12 @@ class Network(Array):
     def new_node_covariate_int(self, name):
         return self.new_node_covariate(name, as_int = True)
 
-    def subnetwork(self, inds):
-        sub_array = self.subarray(inds, inds)
+    def subnetwork(self, inds, view = False):
+        sub_array = self.subarray(inds, inds, view)
 
-        sub = Network(len(inds), self.names[inds])
-        sub.array = sub_array.array
+        sub = Network(len(inds), self.names[inds], self.storage,
+                      self.scratch)
+        sub.data = sub_array.data
         sub.row_covariates = sub_array.row_covariates
         sub.col_covariates = sub_array.col_covariates
         if sub_array.offset:
@@ -52,6 +70,21 @@ class Network(Array):
 
         return sub
 
+    # As Array.save(), with the node names and node covariates; see
+    # network_from_file_npz()
+    def _archive(self):
+        arrays = Array._archive(self)
+        arrays['names'] = self.names
+        arrays['node_names'] = np.array(self.node_covariates.keys())
+        for name in self.node_covariates:
+            arrays['node/%s' % name] = self.node_covariates[name].data
+        return arrays
+
+    # Node covariates are archived once, not as row and column covariates
+    def _archive_node_names(self, kind, covariates):
+        return [name for name in covariates
+                if not covariates[name] is self.node_covariates.get(name)]
+
     def nodes(self):
         return self.names
 
@@ -152,9 +185,7 @@ class Network(Array):
         plt.show()
 
     def show_degree_histograms(self):
-        # Messy since otherwise row/column sums can overflow...
-        r = np.array(self.array.asfptype().sum(1),dtype=np.int).flatten()
-        c = np.array(self.array.asfptype().sum(0),dtype=np.int).flatten()
+        r, c = self.margins()
         
         plt.figure()
         plt.subplot(2,1,1)
@@ -170,16 +201,12 @@ def network_from_networkx(g, cov_names = []):
     names = np.array(g.nodes())
     network = Network(N, names)
 
-    name_to_index = {}
-    for i, n in enumerate(names):
-        name_to_index[n] = i
-    for s, t in g.edges():
-        network.array[name_to_index[s],name_to_index[t]] = True
+    edges = np.array(list(g.edges())).reshape((-1,2))
+    network.add_edges(network.find(edges[:,0]), network.find(edges[:,1]))
 
     for cov_name in cov_names:
-        nodes = g.nodes()
-        covs = [g.node[n][cov_name] for n in nodes]
-        network.new_node_covariate(cov_name).from_pairs(nodes, covs)
+        covs = [g.node[n][cov_name] for n in g.nodes()]
+        network.new_node_covariate(cov_name).from_pairs(names, covs)
 
     return network
 
@@ -192,30 +219,106 @@ def network_from_file_gml(path, cov_names = []):
     in_network = nx.DiGraph(in_network)
     return network_from_networkx(in_network, cov_names)
 
+# Load a Network saved with Network.save(). With mmap = True, the
+# arrays in the file are memory-mapped rather than read in up front.
+def network_from_file_npz(path, mmap = False):
+    arrays = load_archive(path, mmap)
+    N = int(arrays['shape'][0])
+    network = Network(N, arrays['names'], str(arrays['storage']))
+    for name in arrays['node_names']:
+        x = arrays['node/%s' % name]
+        cov = network.new_node_covariate(str(name))
+        cov.dtype, cov.data = x.dtype, x
+    network._unarchive(arrays)
+
+    return network
+
+# Edges given as (source name, target name) pairs, or an E x 2 array
 def network_from_edges(edges):
-    # First pass over edges to determine names and number of nodes
-    names = set()
-    N = 0
-    for n_1, n_2 in edges:
-        if not n_1 in names:
-            names.add(n_1)
-            N += 1
-        if not n_2 in names:
-            names.add(n_2)
-            N += 1
-
-    # Process list of names and assign indices
-    network = Network(N, np.array(list(names)))
-    name_to_index = {}
-    for i, n in enumerate(names):
-        name_to_index[n] = i
-
-    # Second pass over edges to populate network
-    for n_1, n_2 in edges:
-        network[name_to_index[n_1],name_to_index[n_2]] = True
+    edges = np.asarray(edges)
+    names, inds = np.unique(edges.reshape(-1), return_inverse = True)
+    inds = inds.reshape((-1,2))
+
+    N = len(names)
+    network = Network(N, names)
+    network.array = sparse.coo_matrix((np.ones(len(inds), dtype = np.bool),
+                                       (inds[:,0], inds[:,1])),
+                                      shape = (N, N))
 
     return network
 
+# Read a text file of whitespace-separated records, e.g., a SNAP edge
+# list, in chunks of lines. Yields an array of strings with the given
+# number of columns for each chunk; blank lines, comment lines, and
+# any extra fields in a line are skipped, while a line with too few
+# fields raises a ValueError. The file is closed once the consumer
+# stops iterating, even if it does so early.
+def read_columns(path, columns = 2, comments = '#', chunk_lines = 2**18):
+    with open(path, 'r') as infile:
+        line_num = 0
+        while True:
+            lines = list(islice(infile, chunk_lines))
+            if len(lines) == 0:
+                break
+            first_num, line_num = line_num + 1, line_num + len(lines)
+            lines = [(n, l) for n, l in enumerate(lines, first_num)
+                     if not (l.startswith(comments) or l.isspace())]
+            if len(lines) == 0:
+                continue
+            tokens = ' '.join([l for n, l in lines]).split()
+            if len(tokens) != columns * len(lines):
+                tokens = []
+                for n, l in lines:
+                    fields = l.split()
+                    if len(fields) < columns:
+                        raise ValueError('%s, line %d: expected %d fields, '
+                                         'found %d' % (path, n, columns,
+                                                       len(fields)))
+                    tokens.extend(fields[:columns])
+            yield np.array(tokens).reshape((-1,columns))
+
+# Read a file of (node name, value) records. The values are converted
+# by f, applied to the array of value strings, if given, and are
+# otherwise taken to be numeric.
+def read_node_file(path, f = None, comments = '#'):
+    chunks = list(read_columns(path, 2, comments))
+    if len(chunks) == 0:
+        return np.array([]), np.array([])
+    records = np.concatenate(chunks)
+    names, values = records[:,0], records[:,1]
+    if f is None:
+        return names, values.astype(np.float64)
+    else:
+        return names, f(values)
+
+# Load a network from an edge list file, reading at most max_edges
+# edges. Node covariates are attached from the files in node_files, a
+# dictionary mapping covariate names to paths, or to (path, f) pairs
+# to convert the values as in read_node_file.
+def network_from_file_edges(path, node_files = {}, max_edges = None,
+                            comments = '#'):
+    chunks, E = [], 0
+    for chunk in read_columns(path, 2, comments):
+        if not max_edges is None:
+            chunk = chunk[:(max_edges - E)]
+        chunks.append(chunk)
+        E += len(chunk)
+        if E == max_edges:
+            break
+    if len(chunks) == 0:
+        chunks = [np.empty((0,2), dtype = np.str)]
+    network = network_from_edges(np.concatenate(chunks))
+
+    for cov_name in node_files:
+        node_file = node_files[cov_name]
+        if type(node_file) == tuple:
+            names, values = read_node_file(node_file[0], node_file[1],
+                                           comments)
+        else:
+            names, values = read_node_file(node_file, None, comments)
+        network.new_node_covariate(cov_name).from_pairs(names, values)
+
+    return network
 
 # Some "tests"
 if __name__ == '__main__':
@@ -254,7 +357,7 @@ if __name__ == '__main__':
     np.random.shuffle(ord)
     for i in range(10):
         for j in range(i,10):
-            net_3.array[ord[i],ord[j]] = True
+            net_3[ord[i],ord[j]] = True
     net_3.offset_extremes()
     print net_3.offset.matrix()
     print net_3.subnetwork(np.array([2,1,0])).offset.matrix()
@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+
+# Storage backends for the adjacency data held by an Array. Writes are
+# buffered as COO triplets and folded into an immutable compressed
+# (CSR or CSC) matrix the next time the data is read.
+
+import tempfile
+import struct
+import zipfile
+import numpy as np
+import scipy.sparse as sparse
+
+from Utility import row_blocks
+
+# Allocate an array backed by an anonymous file in the scratch
+# directory; the file goes away once the array is garbage collected
+def memmap_array(scratch, shape, dtype = np.float64):
+    if np.prod(shape) == 0:
+        return np.zeros(shape, dtype = dtype)
+    f = tempfile.TemporaryFile(dir = scratch)
+    return np.memmap(f, dtype = dtype, mode = 'w+', shape = shape)
+
+def memmap_copy(scratch, x):
+    mm = memmap_array(scratch, x.shape, x.dtype)
+    mm[...] = x
+    return mm
+
+# Read the arrays in an NPZ archive (as written by np.savez) into a
+# dictionary. With mmap = True, the members stored uncompressed are
+# memory-mapped copy-on-write, rather than read, so only the parts
+# actually used are paged in and changes never reach the file.
+def load_archive(path, mmap = False):
+    npz = np.load(path, allow_pickle = True)
+    arrays = {}
+    if not mmap:
+        for name in npz.files:
+            arrays[name] = npz[name]
+        npz.close()
+        return arrays
+
+    archive = zipfile.ZipFile(path)
+    f = open(path, 'rb')
+    for info in archive.infolist():
+        name = info.filename[:-len('.npy')]
+        if info.compress_type != zipfile.ZIP_STORED:
+            arrays[name] = npz[name]
+            continue
+
+        # Skip the local file header to get to the .npy data
+        f.seek(info.header_offset)
+        header = f.read(30)
+        name_len, extra_len = struct.unpack('<HH', header[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+
+        if dtype.hasobject:
+            arrays[name] = npz[name]
+        elif np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype = dtype)
+        else:
+            arrays[name] = np.memmap(path, dtype = dtype, mode = 'c',
+                                     offset = f.tell(), shape = shape,
+                                     order = fortran and 'F' or 'C')
+    f.close()
+    archive.close()
+    npz.close()
+    return arrays
+
+# Reduce a sequence of writes x[k] to cells (i[k], j[k]) of an M x N
+# matrix to the last write to each cell, returned as (linear index,
+# value) pairs in order of linear index. Negative indices wrap around.
+def last_writes(M, N, i, j, x):
+    i = np.array(i, dtype = np.int64)
+    j = np.array(j, dtype = np.int64)
+    i[i < 0] += M
+    j[j < 0] += N
+    lin = (i * N + j)[::-1]
+    lin, last = np.unique(lin, return_index = True)
+    return lin, np.asarray(x)[::-1][last]
+
+# Assign x[k] to the cells (i[k], j[k]) of a sparse matrix, returning
+# the result in COO format. Later assignments to a cell take
+# precedence over earlier ones and over the existing data.
+def merge_cells(base, i, j, x):
+    M, N = base.shape
+    base = base.tocoo()
+    i = np.concatenate([base.row, np.ravel(i)])
+    j = np.concatenate([base.col, np.ravel(j)])
+    x = np.concatenate([base.data, np.ravel(x).astype(base.dtype)])
+
+    lin, x = last_writes(M, N, i, j, x)
+    nz = x != 0
+    lin, x = lin[nz], x[nz]
+
+    return sparse.coo_matrix((x, (lin // N, lin % N)), shape = (M, N))
+
+# Read-only view of an array, for cached values handed out to callers
+def read_only(x):
+    x = x.view()
+    x.flags.writeable = False
+    return x
+
+# Row margins, column margins and total of a (binary) sparse or dense
+# matrix, as counts of nonzero cells, with the margins read-only
+def count_margins(data):
+    M, N = data.shape
+    if sparse.issparse(data):
+        i, j = data.nonzero()
+        r = np.bincount(i, minlength = M).astype(np.int64)
+        c = np.bincount(j, minlength = N).astype(np.int64)
+    else:
+        nz = np.asarray(data) != 0
+        r = nz.sum(1, dtype = np.int64)
+        c = nz.sum(0, dtype = np.int64)
+    return read_only(r), read_only(c), r.sum()
+
+class SparseStorage(object):
+    def __init__(self, M, N, format = 'csr', dtype = np.bool):
+        self.shape = (M, N)
+        self.format = format
+        self.dtype = dtype
+        self.data = sparse.csr_matrix(self.shape, dtype = dtype)
+        self.data = self.data.asformat(format)
+        self.clear_pending()
+        self.cached_margins = None
+
+    def clear_pending(self):
+        self.pending_i = []
+        self.pending_j = []
+        self.pending_x = []
+
+    def has_pending(self):
+        return len(self.pending_i) > 0
+
+    # Read form of the data; any buffered writes are folded in first
+    def read(self):
+        if self.has_pending():
+            self.flush()
+        return self.data
+
+    # Replace the data wholesale. Sparse input is converted to the
+    # read format; dense input is kept as is, since that is what
+    # model.generate() produces and what most consumers want.
+    def assign(self, x):
+        self.clear_pending()
+        self.cached_margins = None
+        if isinstance(x, PackedMatrix):
+            x = x.tocsr()
+        if sparse.issparse(x):
+            self.data = x.asformat(self.format)
+            if self.data.dtype != self.dtype:
+                self.data = self.data.astype(self.dtype)
+        else:
+            self.data = x
+
+    def write(self, index, x):
+        cells = _cell_index(index)
+        if not cells is None:
+            self.set_cells(cells[0], cells[1], x)
+            return
+
+        if not sparse.issparse(self.data):
+            self.data.__setitem__(index, x)
+        else:
+            # General (slice-based, etc.) assignment falls back to LIL
+            data = self.read().tolil()
+            data.__setitem__(index, x)
+            self.assign(data)
+
+    # Write x[k] to the cells (i[k], j[k]), for index arrays i and j
+    # (broadcast against each other and x). Sparse data buffers the
+    # cells, to be merged in one operation when next read, and cached
+    # margins are kept up to date; dense data is written directly.
+    def set_cells(self, i, j, x):
+        i, j, x = np.broadcast_arrays(np.asarray(i), np.asarray(j),
+                                      np.asarray(x))
+        i, j, x = i.ravel(), j.ravel(), x.ravel()
+
+        if sparse.issparse(self.data):
+            self.pending_i.append(i)
+            self.pending_j.append(j)
+            self.pending_x.append(x.astype(self.dtype))
+            return
+
+        M, N = self.shape
+        lin, x = last_writes(M, N, i, j, x)
+        self.data[lin // N, lin % N] = x
+
+    # Fold buffered COO triplets into the compressed matrix. Later
+    # writes to a cell take precedence over earlier ones and over the
+    # existing data.
+    def flush(self):
+        i = np.concatenate(self.pending_i)
+        j = np.concatenate(self.pending_j)
+        x = np.concatenate(self.pending_x)
+        self.clear_pending()
+
+        if not self.cached_margins is None:
+            self.update_margins(i, j, x)
+        self.data = merge_cells(self.data, i, j, x).asformat(self.format)
+
+    # Row margins, column margins and total of the (binary) data, as
+    # counts of nonzero cells. For sparse data, these are computed on
+    # first use and then updated as buffered writes are folded in. Dense
+    # data is handed out as is by read() and may be changed in place
+    # (as by gibbs_improve_perm on as_dense()), so its margins are not
+    # cached but computed afresh on each call.
+    def margins(self):
+        data = self.read()
+        if not sparse.issparse(data):
+            return count_margins(data)
+
+        if self.cached_margins is None:
+            self.cached_margins = count_margins(data)
+        return self.cached_margins
+
+    # Apply the changes to the margins from writes about to be merged
+    def update_margins(self, i, j, x):
+        M, N = self.shape
+        lin, x = last_writes(M, N, i, j, x)
+        if len(lin) == 0:
+            return
+        i, j = lin // N, lin % N
+        old = np.asarray(self.data[i,j]).reshape(-1) != 0
+        delta = (x != 0).astype(np.int64) - old
+
+        r, c, total = self.cached_margins
+        r, c = r.copy(), c.copy()
+        np.add.at(r, i, delta)
+        np.add.at(c, j, delta)
+        self.cached_margins = (read_only(r), read_only(c),
+                               total + delta.sum())
+
+    def subset(self, rinds, cinds):
+        data = self.read()
+        if not sparse.issparse(data):
+            return data[rinds][:,cinds]
+        if self.format == 'csc':
+            return data[:,cinds][rinds]
+        else:
+            return data[rinds][:,cinds]
+
+    def copy(self):
+        new = SparseStorage(self.shape[0], self.shape[1],
+                            self.format, self.dtype)
+        new.data = self.read().copy()
+        new.cached_margins = self.cached_margins
+        return new
+
+# As SparseStorage, but the arrays making up the compressed matrix (or
+# a dense array, if one is assigned) are kept in files in a scratch
+# directory and paged in by the OS as needed
+class MemmapStorage(SparseStorage):
+    def __init__(self, M, N, scratch, format = 'csr', dtype = np.bool):
+        self.scratch = scratch
+        SparseStorage.__init__(self, M, N, format, dtype)
+
+    def spill(self):
+        x = self.data
+        if sparse.issparse(x):
+            x = x.asformat(self.format)
+            parts = [memmap_copy(self.scratch, a)
+                     for a in (x.data, x.indices, x.indptr)]
+            make = { 'csr': sparse.csr_matrix, 'csc': sparse.csc_matrix }
+            self.data = make[self.format](tuple(parts), shape = self.shape,
+                                          copy = False)
+        elif not isinstance(x, np.memmap):
+            self.data = memmap_copy(self.scratch, np.asarray(x))
+
+    def assign(self, x):
+        SparseStorage.assign(self, x)
+        self.spill()
+
+    def flush(self):
+        SparseStorage.flush(self)
+        self.spill()
+
+    def copy(self):
+        new = MemmapStorage(self.shape[0], self.shape[1], self.scratch,
+                            self.format, self.dtype)
+        new.assign(self.read())
+        return new
+
+# Storage for a subarray view: holds the parent storage and the row
+# and column indices into it. Reads (and margins and subsets) are
+# served from the parent through the indices, so changes to the parent
+# show through; the first write (copy-on-write) detaches the view into
+# an ordinary subset, after which the parent is no longer referenced.
+# While attached, a dense array read from the view is a fresh copy, so
+# changes must be written through the view rather than made in place.
+class ViewStorage(SparseStorage):
+    def __init__(self, parent, rinds, cinds):
+        rinds = np.arange(parent.shape[0])[rinds]
+        cinds = np.arange(parent.shape[1])[cinds]
+        SparseStorage.__init__(self, len(rinds), len(cinds),
+                               parent.format, parent.dtype)
+        self.parent = parent
+        self.rinds = rinds
+        self.cinds = cinds
+        self.data = None
+
+    def detach(self):
+        if not self.parent is None:
+            self.data = self.parent.subset(self.rinds, self.cinds)
+            self.parent = None
+
+    def read(self):
+        if self.parent is None:
+            return SparseStorage.read(self)
+        return self.parent.subset(self.rinds, self.cinds)
+
+    # Not cached while attached, as the parent may change underneath
+    def margins(self):
+        if self.parent is None:
+            return SparseStorage.margins(self)
+        return count_margins(self.read())
+
+    def assign(self, x):
+        self.parent = None
+        SparseStorage.assign(self, x)
+
+    def write(self, index, x):
+        self.detach()
+        SparseStorage.write(self, index, x)
+
+    def set_cells(self, i, j, x):
+        self.detach()
+        SparseStorage.set_cells(self, i, j, x)
+
+    def subset(self, rinds, cinds):
+        if self.parent is None:
+            return SparseStorage.subset(self, rinds, cinds)
+        return self.parent.subset(self.rinds[rinds], self.cinds[cinds])
+
+    def copy(self):
+        if self.parent is None:
+            return SparseStorage.copy(self)
+        return ViewStorage(self.parent, self.rinds, self.cinds)
+
+# Number of set bits in each possible byte
+_popcount = np.array([bin(b).count('1') for b in range(256)], dtype = np.uint8)
+
+# Binary M x N matrix packed eight cells to a byte along rows (as by
+# np.packbits), for holding many sampled networks at once. Margins
+# and sums against covariates work from the packed form, unpacking at
+# most a block of rows at a time.
+class PackedMatrix(object):
+    def __init__(self, M, N, bits = None):
+        self.shape = (M, N)
+        if bits is None:
+            bits = np.zeros((M, (N + 7) // 8), dtype = np.uint8)
+        self.bits = bits
+
+    @staticmethod
+    def from_dense(x):
+        x = np.asarray(x, dtype = np.bool)
+        return PackedMatrix(x.shape[0], x.shape[1], np.packbits(x, axis = 1))
+
+    # Matrix with ones at the cells (i[k], j[k])
+    @staticmethod
+    def from_cells(M, N, i, j):
+        packed = PackedMatrix(M, N)
+        j = np.asarray(j)
+        np.bitwise_or.at(packed.bits, (i, j >> 3),
+                         np.left_shift(1, 7 - (j & 7)).astype(np.uint8))
+        return packed
+
+    @staticmethod
+    def from_sparse(x):
+        M, N = x.shape
+        return PackedMatrix.from_cells(M, N, *x.nonzero())
+
+    def __str__(self):
+        return '<PackedMatrix %d x %d>' % self.shape
+
+    def copy(self):
+        return PackedMatrix(self.shape[0], self.shape[1], self.bits.copy())
+
+    def nbytes(self):
+        return self.bits.nbytes
+
+    # Dense values for the block of rows start:stop
+    def rows(self, start, stop):
+        x = np.unpackbits(self.bits[start:stop], axis = 1)
+        return x[:,:self.shape[1]].view(np.bool)
+
+    def toarray(self):
+        return self.rows(0, self.shape[0])
+
+    def nonzero(self):
+        i, byte = np.nonzero(self.bits)
+        bit = np.unpackbits(self.bits[i,byte].reshape((-1,1)), axis = 1)
+        k, offset = np.nonzero(bit)
+        return i[k], byte[k] * 8 + offset
+
+    def tocsr(self):
+        i, j = self.nonzero()
+        x = np.ones(len(i), dtype = np.bool)
+        return sparse.csr_matrix((x, (i, j)), shape = self.shape)
+
+    # Margins (axis = 1 for rows, 0 for columns) or total, by popcount
+    def sum(self, axis = None, dtype = np.int64):
+        if axis is None:
+            return _popcount[self.bits].sum(dtype = dtype)
+        elif axis == 1:
+            return _popcount[self.bits].sum(1, dtype = dtype)
+        else:
+            c = np.empty((self.bits.shape[1], 8), dtype = dtype)
+            for b in range(8):
+                c[:,b] = ((self.bits >> (7 - b)) & 1).sum(0, dtype = dtype)
+            return c.reshape(-1)[:self.shape[1]]
+
+    # Sum of x over the cells that are set, for x a dense array or an
+    # edge covariate
+    def masked_sum(self, x):
+        total = 0.0
+        M, N = self.shape
+        for start, stop in row_blocks(M, N):
+            if hasattr(x, 'rows'):
+                x_block = x.rows(start, stop)
+            else:
+                x_block = x[start:stop]
+            total += x_block[self.rows(start, stop)].sum()
+        return total
+
+# Available backends, selected with the "storage" argument to Array
+storage_types = { 'csr': lambda M, N, scratch: SparseStorage(M, N, 'csr'),
+                  'csc': lambda M, N, scratch: SparseStorage(M, N, 'csc'),
+                  'memmap': lambda M, N, scratch: MemmapStorage(M, N, scratch) }
+
+def new_storage(storage, M, N, scratch = None):
+    if not storage in storage_types:
+        raise ValueError('unknown storage type "%s"' % storage)
+    return storage_types[storage](M, N, scratch)
+
+# Check if an index addresses individual cells (pairs of integers or
+# integer arrays), returning the row and column indices if so.
+def _cell_index(index):
+    if not (type(index) == tuple and len(index) == 2):
+        return None
+
+    cells = []
+    for ind in index:
+        ind = np.asarray(ind)
+        if not np.issubdtype(ind.dtype, np.integer):
+            return None
+        cells.append(ind)
+    return cells
@@ -31,10 +31,88 @@ def logabsdiffexp(x, y):
 def logit_mean(x):
     return logit(np.mean(inv_logit(x)))
 
+# Split the rows of an M x N array into contiguous blocks, each with
+# at most (roughly) max_cells cells
+def row_blocks(M, N, max_cells = 2 ** 20):
+    step = max(1, max_cells // max(1, N))
+    for start in range(0, M, step):
+        yield start, min(M, start + step)
+
+# Preconditioned conjugate gradient solution of A x = b, for symmetric
+# positive definite A given by its products A_dot(v), and the diagonal
+# preconditioner d (approximating the diagonal of A). Stops when the
+# residual is at most tol in norm, or after max_iter iterations;
+# returns the solution and the number of iterations used.
+def pcg(A_dot, b, d, tol, max_iter):
+    x = np.zeros_like(b)
+    r = b.copy()
+    z = r / d
+    p = z.copy()
+    rz = np.dot(r, z)
+    for it in range(max_iter):
+        if l2(r) <= tol:
+            return x, it
+        Ap = A_dot(p)
+        pAp = np.dot(p, Ap)
+        if pAp <= 0:
+            return x, it
+        step = rz / pAp
+        x += step * p
+        r -= step * Ap
+        z = r / d
+        rz_new = np.dot(r, z)
+        p *= rz_new / rz
+        p += z
+        rz = rz_new
+    return x, max_iter
+
+# Numerically stable log(1 + exp(x))
+def log1pexp(x):
+    return np.logaddexp(0, x)
+
 # Create a hash of the data of an array
 def digest(x):
     return sha1(x.view(np.uint8)).hexdigest()
 
+# Square array over named parameters (e.g., a variance/covariance
+# matrix), indexable positionally or by names, as x['beta_1','kappa']
+# or x['kappa'] for the diagonal entry x['kappa','kappa']. Names are
+# looked up through a dict, so lookups cost the same however many
+# parameters there are.
+class LabeledMatrix(np.ndarray):
+    def __new__(cls, x, names):
+        obj = np.asarray(x).view(cls)
+        obj.names = list(names)
+        obj.index = dict((n, i) for i, n in enumerate(obj.names))
+        return obj
+
+    def __array_finalize__(self, obj):
+        self.names = getattr(obj, 'names', None)
+        self.index = getattr(obj, 'index', None)
+
+    def __reduce__(self):
+        return (LabeledMatrix, (np.asarray(self), self.names))
+
+    def _position(self, key):
+        if isinstance(key, tuple):
+            return tuple([self.index[k] if isinstance(k, basestring) else k
+                          for k in key])
+        if isinstance(key, basestring):
+            return (self.index[key], self.index[key])
+        return key
+
+    def __contains__(self, name):
+        if isinstance(name, basestring):
+            return name in self.index
+        return np.ndarray.__contains__(self, name)
+
+    # Indexing returns plain arrays, as the labels need not carry over
+    def __getitem__(self, key):
+        return np.asarray(self)[self._position(key)]
+
+    def __setitem__(self, key, value):
+        np.asarray(self)[self._position(key)] = value
+
 # Convenience functions for (un)pickling
 pick = lambda x: pickle.dumps(x, protocol = 0)
 unpick = lambda x: pickle.loads(x)
@@ -4,27 +4,98 @@
 # Daniel Klein, 8/1/2012
 
 import numpy as np
+import scipy.sparse as sparse
 import json
+from StringIO import StringIO
 
-def dump_to_json(network):
-    s = { 'nodes': [], 'links': [] }
+def dump_to_json(network, compact = False):
+    out = StringIO()
+    write_json(network, out, compact)
+    return out.getvalue()
+
+# Write the network as JSON to the file-like object outfile, a block of
+# nodes or links at a time, so that no per-node or per-link structures
+# are built for the whole network. The default format is
+#
+#   { "nodes": [{ "name": ..., <covariate>: ..., ... }, ...],
+#     "links": [{ "source": i, "target": j }, ...] }
+#
+# With compact = True, the nodes and links are written as parallel
+# arrays instead (see expand_columnar in scratch.html):
+#
+#   { "format": "columnar", "names": [...],
+#     "covariates": { <covariate>: [...], ... },
+#     "sources": [...], "targets": [...] }
+def write_json(network, outfile, compact = False, block_size = 2**16):
+    cov_names = network.node_covariates.keys()
+    covs = [network.node_covariates[n].data for n in cov_names]
+    N = len(network.names)
+
+    def write_list(blocks):
+        outfile.write('[')
+        first = True
+        for block in blocks:
+            if len(block) == 0: continue
+            if not first:
+                outfile.write(', ')
+            outfile.write(block)
+            first = False
+        outfile.write(']')
+
+    def dump_values(x):
+        return json.dumps(x.tolist())[1:-1]
 
     # Nodes
-    raw = {}
-    for name in network.names:
-        raw[name] = { 'name': name }
-    for cov_name in network.node_covariates:
-        cov = network.node_covariates[cov_name]
-        for name, val in zip(cov.names, cov.data):
-            raw[name][cov_name] = val
-    for name in network.names:
-        s['nodes'].append(raw[name])
-
-    # Edges
-    raw = {}
-    nnz_i, nnz_j = network.array.nonzero()
-    for i, j in zip(nnz_i, nnz_j):
-        i, j = int(i), int(j)
-        s['links'].append({ 'source': i, 'target': j })
-
-    return json.dumps(s)
+    node_blocks = [(start, min(N, start + block_size))
+                   for start in range(0, N, block_size)]
+    if compact:
+        outfile.write('{"format": "columnar", "names": ')
+        write_list(dump_values(network.names[start:stop])
+                   for start, stop in node_blocks)
+        outfile.write(', "covariates": {')
+        for c, (cov_name, cov) in enumerate(zip(cov_names, covs)):
+            if c > 0:
+                outfile.write(', ')
+            outfile.write('%s: ' % json.dumps(cov_name))
+            write_list(dump_values(cov[start:stop])
+                       for start, stop in node_blocks)
+        outfile.write('}')
+    else:
+        def node_block(start, stop):
+            names = network.names[start:stop].tolist()
+            vals = [cov[start:stop].tolist() for cov in covs]
+            nodes = []
+            for n, name in enumerate(names):
+                node = { 'name': name }
+                for cov_name, val in zip(cov_names, vals):
+                    node[cov_name] = val[n]
+                nodes.append(json.dumps(node))
+            return ', '.join(nodes)
+        outfile.write('{"nodes": ')
+        write_list(node_block(start, stop) for start, stop in node_blocks)
+
+    # Links, read from the CSR structure
+    A = network.array
+    if not sparse.isspmatrix_csr(A):
+        A = sparse.csr_matrix(A)
+    A.sort_indices()
+    E = A.indptr[-1]
+    def edge_blocks():
+        for start in range(0, E, block_size):
+            e = np.arange(start, min(E, start + block_size))
+            i = np.searchsorted(A.indptr, e, side = 'right') - 1
+            j = A.indices[start:(start + block_size)]
+            nz = A.data[start:(start + block_size)] != 0
+            yield i[nz], j[nz]
+
+    if compact:
+        outfile.write(', "sources": ')
+        write_list(dump_values(i) for i, j in edge_blocks())
+        outfile.write(', "targets": ')
+        write_list(dump_values(j) for i, j in edge_blocks())
+    else:
+        outfile.write(', "links": ')
+        write_list(', '.join(['{"source": %d, "target": %d}' % (i_e, j_e)
+                              for i_e, j_e in zip(i.tolist(), j.tolist())])
+                   for i, j in edge_blocks())
+    outfile.write('}')
@@ -45,9 +45,9 @@ for i, degree_het in enumerate(['Normal', 'Gamma', 'Uniform', 'None']):
                 model.match_kappa(subnet, kappa_target)
                 subnet.generate(model)
                 
-                subnet.offset_extremes()
+                active_set = subnet.offset_extremes()
 
-                active = np.isfinite(subnet.offset.matrix()).sum()
+                active = sum([len(r) * len(c) for r, c in active_set])
 
                 if degree_het == 'None':
                     data_none[k, l] = active
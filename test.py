@@ -120,19 +120,21 @@ def do_experiment(params):
             c = np.sqrt(12) / 2
             def f_x(i_1, i_2):
                 return np.random.uniform(-c * params['cov_unif_sd'],
-                                         c * params['cov_unif_sd'])
+                                         c * params['cov_unif_sd'],
+                                         np.broadcast(i_1, i_2).shape)
         elif params['cov_norm_sd'] > 0.0:
             def f_x(i_1, i_2):
-                return np.random.normal(0, params['cov_norm_sd'])
+                return np.random.normal(0, params['cov_norm_sd'],
+                                        np.broadcast(i_1, i_2).shape)
         elif params['cov_disc_sd'] > 0.0:
             def f_x(i_1, i_2):
-                return (params['cov_disc_sd'] *
-                        (np.sign(np.random.random() - 0.5)))
+                u = np.random.random(np.broadcast(i_1, i_2).shape)
+                return params['cov_disc_sd'] * np.sign(u - 0.5)
         else:
             print 'Error: no covariate distribution specified.'
             sys.exit()
 
-        arr.new_edge_covariate(name).from_binary_function_ind(f_x)
+        arr.new_edge_covariate(name).from_array_function_ind(f_x)
 
     # Generate large network, if necessary
     if not params['sampling'] == 'new':
@@ -94,13 +94,11 @@ for row in range(1, ws_neurons.nrows):
 cov = net.new_node_covariate('soma_pos')
 cov.from_pairs(soma_pos.keys(), soma_pos.values())
 if params['cov_soma_diff']:
-    def f_soma_pos_diff(n_1, n_2):
-        return (soma_pos[n_1] - soma_pos[n_2])
-    add_cov_f('soma_dist', f_soma_pos_diff)
+    cov_names.append('soma_dist')
+    net.new_factored_edge_covariate('soma_dist', cov, cov, 'difference')
 if params['cov_soma_dist']:
-    def f_soma_pos_dist(n_1, n_2):
-        return abs(soma_pos[n_1] - soma_pos[n_2])
-    add_cov_f('soma_dist', f_soma_pos_dist)
+    cov_names.append('soma_dist')
+    net.new_factored_edge_covariate('soma_dist', cov, cov, 'distance')
 if params['cov_soma_dir']:
     def f_soma_pos_dir(n_1, n_2):
         return soma_pos[n_2] > soma_pos[n_1]
@@ -28,7 +28,7 @@ for covariate in covariates:
     x_node = np.random.normal(0, 1.0, N)
     def f_x(i_1, i_2):
         return abs(x_node[i_1] - x_node[i_2]) < 0.3
-    net.new_edge_covariate(covariate).from_binary_function_ind(f_x)
+    net.new_edge_covariate(covariate).from_array_function_ind(f_x)
 net.generate(data_model)
 print 'True beta_1: %.2f' % data_model.beta['x_1']
 
@@ -57,7 +57,7 @@ for rep in range(10):
     
     m = np.array([fit_model.beta['x_1'], fit_model.beta['x_2']])
     vc = fit_model.variance_covariance
-    S = np.array([[vc[('x_1','x_1')], vc['x_1','x_2']],
-                  [vc[('x_2','x_1')], vc['x_2','x_2']]])
+    inds = [vc.index['x_1'], vc.index['x_2']]
+    S = vc[np.ix_(inds, inds)]
     draw_confidence(ax, m, S)
 plt.show()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# Check how the logistic fits behave when a covariate separates the
+# edges: the estimates should stay finite and the fit should be
+# reported as not converged, rather than silently returned.
+
+import numpy as np
+
+from Network import Network
+from Models import StationaryLogistic, fit_binomial_logit
+
+# Parameters
+params = { 'N': 50,
+           'kappa': -1.0,
+           'beta': 1.0 }
+
+
+# Set random seed for reproducible output
+np.random.seed(137)
+
+# Report parameters for the run
+print 'Parameters:'
+for field in params:
+    print '%s: %s' % (field, str(params[field]))
+print
+
+# Initialize full network, with a covariate comparing node values
+net = Network(params['N'])
+x_node = np.random.normal(0, 1.0, params['N'])
+def f_x(i_1, i_2):
+    return 1.0 * (x_node[i_1] > x_node[i_2])
+net.new_edge_covariate('x').from_array_function_ind(f_x)
+
+# Generate network from the data model
+data_model = StationaryLogistic()
+data_model.kappa = params['kappa']
+data_model.beta['x'] = params['beta']
+net.generate(data_model)
+
+# Fit and report the estimates, convergence and NLL
+def report(title):
+    fit_model = StationaryLogistic()
+    fit_model.beta['x'] = None
+    fit_model.fit_logistic(net)
+    print '%s:' % title
+    print '  kappa = %.2f, beta = %.2f' % \
+      (fit_model.kappa, fit_model.beta['x'])
+    print '  converged: %s' % fit_model.fit_info['converged']
+    print '  finite: %s' % \
+      (np.isfinite(fit_model.kappa) and np.isfinite(fit_model.beta['x']))
+    print '  NLL: %.4f' % fit_model.nll(net)
+    print
+
+# Unseparated data; the fit should converge
+report('Unseparated')
+
+# Place edges exactly where the covariate is set; the fit should be
+# flagged as not converged, with finite estimates
+x = net.edge_covariates['x'].matrix()
+i, j = np.where(net.as_dense())
+net.remove_edges(i, j)
+i, j = np.where(x > 0)
+net.add_edges(i, j)
+report('Separated')
+
+# The same on grouped data directly: two groups with no successes in
+# one and no failures in the other
+coefs, converged = fit_binomial_logit(np.array([[1.0, 0.0], [1.0, 1.0]]),
+                                      np.array([0.0, 10.0]),
+                                      np.array([10.0, 10.0]))
+print 'Grouped separated:'
+print '  coefficients: %s' % str(coefs)
+print '  converged: %s' % converged
+print '  finite: %s' % np.all(np.isfinite(coefs))
@@ -3,11 +3,11 @@
 # Test of "new style" network inference on sparse data
 # Daniel Klein, 5/22/2012
 
-from datetime import date, timedelta
+import numpy as np
 
-from Network import network_from_edges
+from Network import network_from_edges, read_columns, read_node_file
 from Models import Stationary, StationaryLogistic, NonstationaryLogistic
-from Web import dump_to_json
+from Web import write_json
 
 # Parameters
 params = { 'file_network': 'data/cit-HepTh/cit-HepTh.txt',
@@ -19,70 +19,64 @@ params = { 'file_network': 'data/cit-HepTh/cit-HepTh.txt',
            'verbose': False }
 
 
-# Import covariate data from file
-dates = {}
-for line in open(params['file_dates'], 'r').readlines():
-    line = line[:-2]
-    if line[0] == '#': continue
-    if line == '': continue
-    n, d = line.split('\t')
-    if len(n) == 9:
-        assert(n[:2] == '11')
-        n = n[2:]
-    d_1, d_2, d_3 = d.split('-')
-    dates[n] = date(int(d_1), int(d_2), int(d_3))
+# Import covariate data from file, as days since the epoch
+def parse_dates(d):
+    return d.astype('datetime64[D]').astype(np.int64)
+date_names, date_days = read_node_file(params['file_dates'], parse_dates)
+cross_listed = np.char.str_len(date_names) == 9
+assert(np.all(np.char.startswith(date_names[cross_listed], '11')))
+date_names[cross_listed] = [n[2:] for n in date_names[cross_listed]]
+o = np.argsort(date_names)
+date_names, date_days = date_names[o], date_days[o]
+def lookup_dates(names):
+    inds = np.searchsorted(date_names, names).clip(0, len(date_names) - 1)
+    return date_names[inds] == names, date_days[inds]
 
 # Import network data from file
 edges = []
-for line in open(params['file_network'], 'r').readlines():
-    line = line[:-2]
-    if line[0] == '#': continue
-    if line == '': continue
-    n_1, n_2 = line.split('\t')
-    if not (n_1 in dates and n_2 in dates): continue
-    if dates[n_1] < dates[n_2]: continue
-    edges.append((n_1, n_2))
-    if len(edges) >= params['import_limit_edges']: break
+n_edges = 0
+for chunk in read_columns(params['file_network']):
+    known_1, d_1 = lookup_dates(chunk[:,0])
+    known_2, d_2 = lookup_dates(chunk[:,1])
+    chunk = chunk[known_1 & known_2 & (d_1 >= d_2)]
+    edges.append(chunk[:(params['import_limit_edges'] - n_edges)])
+    n_edges += len(edges[-1])
+    if n_edges >= params['import_limit_edges']: break
+edges = np.concatenate(edges)
 
 # Plot the raw data
 if params['plot']:
     import matplotlib.pyplot as plt
     plt.figure()
-    x, y = [], []
-    for n_1, n_2 in edges:
-        x.append(dates[n_1].toordinal())
-        y.append(dates[n_2].toordinal())
-    plt.plot(x, y, '.')
+    plt.plot(lookup_dates(edges[:,0])[1], lookup_dates(edges[:,1])[1], '.')
     plt.show()
 
 # Initialize network from citation data
 net = network_from_edges(edges)
 if params['plot']: net.show_degree_histograms()
 
+# Add publication order node covariate
+pub_date = net.new_node_covariate('pub_date')
+pub_date.from_pairs(date_names, date_days)
+
 # Process publication date data in covariates
 cov_names = []
 for l, u in zip([0] + params['pub_diff_classes'], params['pub_diff_classes']):
     cov_name = 'pub_diff_%d-%d' % (l, u)
     cov_names.append(cov_name)
+    def f_pub_date_diff_in_range(d_1, d_2):
+        return (l <= d_1 - d_2) & (d_1 - d_2 < u)
     cov = net.new_edge_covariate(cov_name)
-    def f_pub_date_diff_in_range(n_1, n_2):
-        return timedelta(l) <= dates[n_1] - dates[n_2] < timedelta(u)
-    cov.from_binary_function_name(f_pub_date_diff_in_range)
-
-# Add publication order node covariate
-pub_dates = [dates[p].toordinal() for p in net.names]
-net.new_node_covariate('pub_date').from_pairs(net.names, pub_dates)
+    cov.from_node_covariates(pub_date, pub_date, f_pub_date_diff_in_range)
 if params['plot']:
-    net.node_covariates['pub_date'].show_histogram()
+    pub_date.show_histogram()
     net.show_heatmap('pub_date')
 
 # Exclude impossible edges using infinite offset
-def f_impossible_pub_order(n_1, n_2):
-    if dates[n_1] < dates[n_2]:
-        return -20.0
-    else:
-        return 0
-net.initialize_offset().from_binary_function_name(f_impossible_pub_order)
+def f_impossible_pub_order(d_1, d_2):
+    return np.where(d_1 < d_2, -20.0, 0.0)
+net.initialize_offset().from_node_covariates(pub_date, pub_date,
+                                             f_impossible_pub_order)
 
 # Fit model
 def fit_and_summarize(name, fit_model, use_covs):
@@ -114,5 +108,5 @@ fit_and_summarize('Nonstationary', NonstationaryLogistic(), True)
 #    net.show_heatmap('alpha_in')
 
 outfile = open('scratch.json', 'w')
-outfile.write(dump_to_json(net))
+write_json(net, outfile)
 outfile.close()